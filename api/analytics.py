@@ -187,8 +187,9 @@ class Analytics(APIView):
 
         # now iterate through the subcounties and do the math
         odk_form = OdkForms()
+        labels = odk_form.get_values_from_dictionary(settings.SUB_COUNTIES)
         for sc_name in settings.SUB_COUNTIES:
-            full_name = odk_form.get_value_from_dictionary(sc_name)
+            full_name = labels[sc_name]
             if sc_name not in all_data:
                 all_data[sc_name] = {'syndromic': 0, 'nd1': 0, 'zero': 0, 'total': 0}
 
@@ -270,11 +271,12 @@ class Analytics(APIView):
         # ordering and getting top 5
         to_return = []
         i = 1
-        odk_form = OdkForms()
-        for name_ in (sorted(all_data, reverse=True, key=lambda name_:all_data[name_]['total'])):
+        top_names = sorted(all_data, reverse=True, key=lambda name_:all_data[name_]['total'])[:10]
+        labels = OdkForms().get_values_from_dictionary(top_names)
+        for name_ in top_names:
             to_return.append({
                 'rank': i,
-                'name': odk_form.get_value_from_dictionary(name_),
+                'name': labels.get(name_, str(name_)),
                 'records': all_data[name_]['total']
             })
             i+=1
@@ -317,11 +319,12 @@ class Analytics(APIView):
 
         i = 1
         rank_data = []
-        odk_form = OdkForms()
+        summed_reports = summed_reports[:5]
+        labels = OdkForms().get_values_from_dictionary([rep['reporter'] for rep in summed_reports])
         for rep in summed_reports:
             reporter_tel = Recipients.objects.get(username=rep['reporter'])
             rank_data.append({
-                'name': odk_form.get_value_from_dictionary(rep['reporter']),
+                'name': labels.get(rep['reporter'], str(rep['reporter'])),
                 'records': rep['sum_reports'],
                 'tel': reporter_tel.cell_no if reporter_tel.cell_no else reporter_tel.alternative_cell_no
             })
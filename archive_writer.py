@@ -0,0 +1,227 @@
+"""Zip archives of the sheets of an export
+
+Writes the sheets of an export as a zip archive with a file per sheet of the output structure, either as CSV, Parquet or Arrow IPC
+files. The sheets are spooled as the DataFrames of the columnar flattener, or as DataFrames of batches of rows, and the archive is
+generated as a stream of bytes like the Excel exports. The Parquet and Arrow files are written in record batches, and pyarrow is
+only imported when they are requested. Their columns are typed after the declared types of the questions in the flatten plans,
+like the tables of the saved views
+"""
+import io
+import csv
+import pickle
+import zipfile
+
+import pandas as pd
+
+from .excel_writer import SpooledSheets, order_fields
+from .columnar import is_missing, link_columns
+from .column_types import parse_column_value
+from .terminal_output import Terminal
+
+terminal = Terminal()
+
+
+class SheetArchiveWriter(SpooledSheets):
+    # the extension of the files in the archive for each export format
+    file_extensions = {'csv.zip': 'csv', 'parquet': 'parquet', 'arrow': 'arrow'}
+    content_type = 'application/zip'
+
+    def __init__(self, d_format, declared_types=None, batch_size=10000):
+        super().__init__()
+        if d_format not in self.file_extensions:
+            raise ValueError("Unsupported export format '%s'" % d_format)
+        if d_format != 'csv.zip':
+            # fail before the export is started when pyarrow is not installed
+            import pyarrow
+
+        self.d_format = d_format
+        # the SQL types of the declared questions, keyed by (sheet_name, clean_key)
+        self.declared_types = declared_types if declared_types is not None else {}
+        self.batch_size = batch_size
+
+    def spool_tables(self, tables):
+        # save the (sheet_name, DataFrame) tuples in a temporary file per sheet, returns the number of rows in the main sheet
+        main_rows = 0
+        for sheet_name, table in tables:
+            spool = self.add_spool(sheet_name)
+            pickle.dump(table, spool['file'], pickle.HIGHEST_PROTOCOL)
+            spool['count'] += len(table)
+            spool['tables'] = spool.get('tables', 0) + 1
+            if sheet_name == 'main':
+                main_rows += len(table)
+
+        return main_rows
+
+    def spool_rows(self, rows):
+        # the rows are spooled as DataFrames of batch_size rows
+        return self.spool_tables(self.iter_row_tables(rows))
+
+    def iter_row_tables(self, rows):
+        batches = {}
+        for sheet_name, row in rows:
+            if sheet_name not in batches:
+                # keep the sheets in the order in which they are found
+                self.add_spool(sheet_name)
+                batches[sheet_name] = []
+
+            batches[sheet_name].append(row)
+            if len(batches[sheet_name]) == self.batch_size:
+                yield (sheet_name, pd.DataFrame(batches[sheet_name], dtype=object))
+                batches[sheet_name] = []
+
+        for sheet_name, batch in batches.items():
+            if len(batch) != 0:
+                yield (sheet_name, pd.DataFrame(batch, dtype=object))
+
+    def iter_spooled_tables(self, sheet_name):
+        spool = self.spools.get(sheet_name)
+        if spool is None:
+            return
+
+        spool['file'].seek(0)
+        for i in range(spool.get('tables', 0)):
+            yield pickle.load(spool['file'])
+
+    def archive_name(self, name):
+        # eg Form123_20240101_120000.parquet.zip
+        return '%s.%s.zip' % (name, self.file_extensions[self.d_format])
+
+    def iter_archive(self, structure, chunk_size=65536):
+        """
+        Generate the archive as chunks of bytes, with a file per sheet in the structure, starting with the main sheet
+        """
+        sheet_files = [(sheet_name, '%s.%s' % (sheet_name, self.file_extensions[self.d_format]), order_fields(structure[sheet_name])) for sheet_name in self.sheet_names(structure)]
+        # the parquet files are already compressed
+        compression = zipfile.ZIP_STORED if self.d_format == 'parquet' else zipfile.ZIP_DEFLATED
+        return self.iter_zip([], sheet_files, compression, chunk_size)
+
+    def write_sheet(self, sheet_file, sheet_name, fields):
+        if self.d_format == 'csv.zip':
+            return self.write_csv(sheet_file, sheet_name, fields)
+        return self.write_columnar(sheet_file, sheet_name, fields)
+
+    def write_csv(self, sheet_file, sheet_name, fields):
+        # write the sheet as CSV, yielding after each spooled DataFrame. The missing values are left empty
+        text_file = io.TextIOWrapper(sheet_file, encoding='utf-8', newline='')
+        csv.writer(text_file).writerow(fields)
+        for table in self.iter_spooled_tables(sheet_name):
+            table.reindex(columns=fields).to_csv(text_file, header=False, index=False, lineterminator='\r\n')
+            text_file.flush()
+            yield
+
+        text_file.flush()
+        # the zip entry is closed with the archive, so don't let the wrapper close it
+        text_file.detach()
+        yield
+
+    def write_columnar(self, sheet_file, sheet_name, fields):
+        # write the sheet as a Parquet or Arrow IPC file in record batches, yielding after each batch
+        import pyarrow as pa
+
+        column_types = self.column_types(sheet_name, fields)
+        schema = pa.schema([(field, column_types[field][0]) for field in fields])
+        if self.d_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(sheet_file, schema)
+            write_batch = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer = pa.ipc.new_file(sheet_file, schema)
+            write_batch = writer.write_batch
+
+        try:
+            for table in self.iter_spooled_tables(sheet_name):
+                for start in range(0, len(table), self.batch_size):
+                    batch = table.iloc[start:start + self.batch_size]
+                    arrays = [pa.array(self.column_values(batch, field, column_types[field][1]), column_types[field][0]) for field in fields]
+                    write_batch(pa.record_batch(arrays, schema=schema))
+                    yield
+        finally:
+            writer.close()
+        yield
+
+    def column_types(self, sheet_name, fields):
+        """
+        Determine the arrow type of each column, with the type of its values
+
+        The columns of the questions declared as integer, decimal, date or dateTime in the flatten plans get the matching arrow
+        type, unless one of their values can't be parsed as such, and the other declared questions and the link columns are strings.
+        The columns which are not declared, eg the metadata of the submissions, are boolean, int64 or float64 when all their values
+        are of that kind, with the ints and floats promoted to float64, and strings otherwise
+
+        Returns a dict of field: (arrow type, value type), where the value type is the SQL type of the declared column, 'text' for
+        the string columns and None for the other columns, whose values are kept as they are
+        """
+        import pyarrow as pa
+
+        arrow_types = {'bigint': pa.int64(), 'double precision': pa.float64(), 'date': pa.date32(), 'timestamptz': pa.timestamp('us', tz='UTC'), 'text': pa.string()}
+        value_types = {}
+        kinds = {}
+        for field in fields:
+            if field in link_columns:
+                value_types[field] = 'text'
+            elif (sheet_name, field) in self.declared_types:
+                value_types[field] = self.declared_types[(sheet_name, field)]
+            else:
+                kinds[field] = set()
+
+        for table in self.iter_spooled_tables(sheet_name):
+            for field in fields:
+                if field not in table.columns:
+                    continue
+
+                if field in kinds:
+                    kinds[field].update(self.value_kind(value) for value in table[field])
+                elif value_types[field] != 'text':
+                    try:
+                        for value in table[field]:
+                            self.column_value(value, value_types[field])
+                    except ValueError:
+                        terminal.tprint("\tThe column '%s' has values which are not %s, saving it as text" % (field, value_types[field]), 'warn')
+                        value_types[field] = 'text'
+
+        column_types = {}
+        for field in fields:
+            if field not in kinds:
+                column_types[field] = (arrow_types[value_types[field]], value_types[field])
+                continue
+
+            field_kinds = kinds[field] - {None}
+            if field_kinds == {'bool'}:
+                column_types[field] = (pa.bool_(), None)
+            elif field_kinds == {'int'}:
+                column_types[field] = (pa.int64(), None)
+            elif len(field_kinds) != 0 and field_kinds <= {'int', 'float'}:
+                column_types[field] = (pa.float64(), None)
+            else:
+                column_types[field] = (pa.string(), 'text')
+
+        return column_types
+
+    def value_kind(self, value):
+        if value is None or is_missing(value):
+            return None
+        elif isinstance(value, bool):
+            return 'bool'
+        elif isinstance(value, int):
+            # the ints which don't fit in an int64 are kept as strings
+            return 'int' if -2 ** 63 <= value < 2 ** 63 else 'str'
+        elif isinstance(value, float):
+            return 'float'
+        return 'str'
+
+    def column_values(self, table, field, value_type):
+        # the values of a column of a spooled DataFrame, the columns which are not in the DataFrame are missing
+        if field not in table.columns:
+            return [None] * len(table)
+        return [self.column_value(value, value_type) for value in table[field]]
+
+    def column_value(self, value, value_type):
+        # the missing values are nulls. The values of the string columns are converted to strings and the values of the declared
+        # columns are parsed, while the ints of the float columns are converted by arrow
+        if value is None or is_missing(value):
+            return None
+        elif value_type == 'text':
+            return str(value)
+        elif value_type is not None:
+            return parse_column_value(value, value_type)
+        return value
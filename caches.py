@@ -0,0 +1,167 @@
+"""Process-local caches
+
+Contains a size-bounded LRU cache, the cache of the dictionary items used to label the codes in the dashboards and the
+caches of the processed form structures and flatten plans
+"""
+import time
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+
+
+class LRUCache():
+    """
+    A thread safe mapping which evicts the least recently used items once it holds max_size items
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        # returns a tuple (is_found, value), so that None can be cached as well
+        with self.lock:
+            if key not in self.items:
+                return (False, None)
+            self.items.move_to_end(key)
+            return (True, self.items[key])
+
+    def get(self, key, default=None):
+        (is_found, value) = self.lookup(key)
+        return value if is_found else default
+
+    def set(self, key, value):
+        # returns the number of items which have been evicted
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            evicted = 0
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+
+class DictionaryCache():
+    """
+    A process-local cache of the dictionary_items table, mapping a t_key to its t_value
+
+    The whole table is loaded on first use, as long as it fits in the cache, and keys which are not cached are looked up
+    in the database. Keys which are not in the dictionary are cached too, unless the whole table is cached. Once an item is
+    evicted, the keys which are not cached are looked up again. The cache is reloaded when it is invalidated after new
+    dictionary items are saved, and after DICTIONARY_CACHE_TTL seconds to pick the items saved by other processes
+    """
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size if max_size is not None else getattr(settings, 'DICTIONARY_CACHE_SIZE', 50000)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'DICTIONARY_CACHE_TTL', 300)
+        self.items = LRUCache(self.max_size)
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.is_complete = False
+
+    def load(self):
+        # when a key is defined in several forms, use the first saved value
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT t_key, t_value FROM (
+                    SELECT DISTINCT ON (t_key) t_key, t_value, id FROM dictionary_items ORDER BY t_key, id
+                ) AS a ORDER BY id LIMIT %s
+            """, [self.max_size])
+            all_items = cursor.fetchall()
+
+        self.items.clear()
+        for t_key, t_value in all_items:
+            self.items.set(t_key, t_value)
+
+        # if the whole table fits in the cache, a key which is not cached is not in the dictionary
+        self.is_complete = len(all_items) < self.max_size
+        self.loaded_at = time.monotonic()
+
+    def get(self, t_key):
+        """
+        Get the value of a key, or None if the key is not in the dictionary
+        """
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.load()
+            is_complete = self.is_complete
+
+        (is_found, t_value) = self.items.lookup(t_key)
+        if is_found:
+            return t_value
+
+        if is_complete:
+            # the key is not in the dictionary, and caching the miss could evict a dictionary item
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT t_value FROM dictionary_items WHERE t_key = %s ORDER BY id LIMIT 1", [t_key])
+            row = cursor.fetchone()
+        t_value = None if row is None else row[0]
+
+        self.cache_item(t_key, t_value)
+        return t_value
+
+    def get_many(self, t_keys):
+        """
+        Get the values of several keys, resolving the keys which are not cached in one query
+
+        Returns a mapping of the keys to their values, with None for the keys which are not in the dictionary
+        """
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.load()
+            is_complete = self.is_complete
+
+        t_values = {}
+        missing_keys = []
+        for t_key in set(t_keys):
+            (is_found, t_value) = self.items.lookup(t_key)
+            if is_found or is_complete:
+                t_values[t_key] = t_value
+            else:
+                missing_keys.append(t_key)
+
+        if len(missing_keys) != 0:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT DISTINCT ON (t_key) t_key, t_value FROM dictionary_items WHERE t_key = ANY(%s) ORDER BY t_key, id", [missing_keys])
+                found_values = dict(cursor.fetchall())
+            for t_key in missing_keys:
+                t_values[t_key] = found_values.get(t_key)
+
+        for t_key in missing_keys:
+            self.cache_item(t_key, t_values[t_key])
+
+        return t_values
+
+    def cache_item(self, t_key, t_value):
+        # the cache no longer holds the whole table once an item has been evicted
+        if self.items.set(t_key, t_value) != 0:
+            self.is_complete = False
+
+    def invalidate(self):
+        with self.lock:
+            self.items.clear()
+            self.loaded_at = None
+
+
+dictionary_cache = DictionaryCache()
+# the processed form structures, keyed by (form_id, form_version). The cached structures are shared, so they should not be modified
+form_structures_cache = LRUCache(getattr(settings, 'FORM_STRUCTURES_CACHE_SIZE', 100))
+# the compiled flatten plans of the forms, keyed by (form_id, form_version)
+flatten_plans_cache = LRUCache(getattr(settings, 'FORM_STRUCTURES_CACHE_SIZE', 100))
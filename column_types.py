@@ -0,0 +1,42 @@
+"""The types of the columns of the saved views and the archive exports
+
+Maps the declared XForm types of the questions to the SQL types of their columns, and parses the answers of the typed columns
+"""
+import math
+
+from datetime import datetime
+
+# the SQL types of the columns of the declared XForm types, the other columns are text
+view_column_types = {'integer': 'bigint', 'decimal': 'double precision', 'date': 'date', 'today': 'date', 'dateTime': 'timestamptz', 'start': 'timestamptz', 'end': 'timestamptz'}
+
+
+def parse_column_value(value, sql_type):
+    """
+    Parse a value of a column of the SQL type, returns None for a null and raises a ValueError when the value doesn't match the type
+
+    The missing values, saved as N/A, are nulls
+    """
+    if value is None or value in ('N/A', ''):
+        return None
+    if isinstance(value, bool):
+        raise ValueError("'%s' is not a %s" % (str(value), sql_type))
+
+    try:
+        if sql_type == 'bigint':
+            number = int(value.strip()) if isinstance(value, str) else int(value)
+            if isinstance(value, float) and value != number or not -2 ** 63 <= number < 2 ** 63:
+                raise ValueError
+            return number
+        elif sql_type == 'double precision':
+            number = float(value)
+            if not math.isfinite(number):
+                raise ValueError
+            return number
+        elif sql_type == 'date':
+            return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+        elif sql_type == 'timestamptz':
+            return datetime.fromisoformat(value.strip())
+    except (TypeError, ValueError, AttributeError, OverflowError):
+        pass
+
+    raise ValueError("'%s' is not a %s" % (str(value), sql_type))
@@ -0,0 +1,127 @@
+"""Columnar flattening of the submissions
+
+Flattens a batch of submissions into a pandas DataFrame per sheet, ie the main sheet and a sheet per repeat group, with the same
+rows as the sheets of the nested flattener: the None answers are 'N/A', the missing answers are nulls, each repeat is replaced
+by a 'Check <repeat>' link in its parent row and the rows of the repeats are linked by the unique_id, top_id and parent_id columns.
+The repeats are expanded with DataFrame.explode instead of walking each submission, so it is suited to the archive exports of
+large forms
+"""
+import math
+import functools
+
+import pandas as pd
+
+# the columns which link the rows of a repeat to their submission and parent row
+link_columns = ['unique_id', 'top_id', 'parent_id']
+
+
+def flatten_submissions(submissions, clean_key, pk_name='hh_id', indexes=None, nodes_of_interest=None, converters=None, structure=None):
+    """
+    Flatten a batch of raw submissions into a DataFrame per sheet
+
+    clean_key maps a raw key, eg group/question, to its column name. The rows are numbered like process_node and process_list,
+    continuing from the indexes, a dict of sheet_name: next index, which is updated so that the next batch continues the numbering.
+    nodes_of_interest limits the columns of the main sheet and converters maps a column name to a function to clean its values.
+    The sheets and their columns are added to structure, a dict of sheet_name: columns like the output structure of the nested
+    flattener, and the rows of a sheet which is not in it yet are numbered from 1
+
+    Returns a dict of sheet_name: DataFrame, with the parent sheets before their repeats
+    """
+    indexes = indexes if indexes is not None else {}
+    converters = converters if converters is not None else {}
+    structure = structure if structure is not None else {}
+
+    main = clean_columns(pd.DataFrame(submissions, dtype=object), clean_key, nodes_of_interest, converters)
+    start = indexes.get('main', 1)
+    main.insert(0, 'unique_id', number_rows(pk_name, start, len(main)))
+    indexes['main'] = start + len(main)
+    if 'main' not in structure:
+        structure['main'] = ['unique_id']
+
+    tables = {}
+    add_sheet(tables, 'main', main, clean_key, indexes, converters, structure)
+    return {sheet_name: frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True, sort=False) for sheet_name, frames in tables.items()}
+
+
+def add_sheet(tables, sheet_name, frame, clean_key, indexes, converters, structure):
+    # add the columns of the sheet to the structure and expand its repeats into their own sheets, then add the sheet to the tables
+    sheet_fields = structure[sheet_name]
+    for column in frame.columns:
+        if column not in sheet_fields:
+            sheet_fields.append(column)
+
+    # register the sheet before its repeats, so that the parent sheets come first
+    frames = tables.setdefault(sheet_name, [])
+    top_ids = frame['top_id'] if 'top_id' in frame.columns else frame['unique_id']
+    for column in list(frame.columns):
+        if column in link_columns:
+            continue
+
+        values = frame[column]
+        is_list = values.map(lambda value: type(value) is list).astype(bool)
+        if is_list.any():
+            frame[column] = values.where(~is_list, 'Check ' + column)
+            add_repeat(tables, column, frame['unique_id'][is_list], top_ids[is_list], values[is_list], clean_key, indexes, converters, structure)
+
+    frames.append(frame)
+
+
+def add_repeat(tables, sheet_name, parent_ids, top_ids, lists, clean_key, indexes, converters, structure):
+    # explode the lists of a repeat into a row per item, keeping the ids of the parent rows
+    if sheet_name not in structure:
+        # like process_list, the sheet is added even when the repeats are empty, and its rows are numbered from 1
+        structure[sheet_name] = list(link_columns)
+        indexes[sheet_name] = 1
+
+    items = pd.DataFrame({'top_id': top_ids.values, 'parent_id': parent_ids.values, 'item': lists.values}).explode('item')
+    # only the nodes of a repeat are rows of its sheet
+    items = items[items['item'].map(lambda item: type(item) is dict).astype(bool)]
+
+    repeat = clean_columns(pd.DataFrame(list(items['item']), dtype=object), clean_key, None, converters)
+    start = indexes.get(sheet_name, 1)
+    repeat.insert(0, 'unique_id', number_rows(sheet_name + '_', start, len(repeat)))
+    repeat.insert(1, 'top_id', items['top_id'].values)
+    repeat.insert(2, 'parent_id', items['parent_id'].values)
+    indexes[sheet_name] = start + len(repeat)
+
+    add_sheet(tables, sheet_name, repeat, clean_key, indexes, converters, structure)
+
+
+def clean_columns(frame, clean_key, nodes_of_interest, converters):
+    """
+    Rename the raw keys to their clean names and clean their values like process_node
+
+    The _geolocation, the link columns and the columns which are not of interest are dropped. When several keys have the same
+    clean name, the value of the last key which is set in a row is kept
+    """
+    columns = {}
+    for position, key in enumerate(frame.columns):
+        column = clean_key(key)
+        if column == '_geolocation' or column in link_columns:
+            continue
+        if nodes_of_interest is not None and column not in nodes_of_interest:
+            continue
+
+        values = frame.iloc[:, position].map(functools.partial(clean_value, converter=converters.get(column)))
+        columns[column] = values.combine_first(columns[column]) if column in columns else values
+
+    return pd.DataFrame(columns, index=frame.index, dtype=object)
+
+
+def clean_value(value, converter=None):
+    # the missing answers are NaN and stay missing, while the None answers are 'N/A'
+    if is_missing(value):
+        return value
+    if converter is not None:
+        value = converter(value)
+
+    return 'N/A' if value is None else value
+
+
+def is_missing(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+def number_rows(prefix, start, count):
+    # the unique ids of the rows, eg hh_id1, hh_id2...
+    return pd.array([prefix + str(index) for index in range(start, start + count)], dtype=object)
@@ -1,94 +1,263 @@
-from pyexcelerate import Workbook
-import logging, traceback, json
+import re
+import math
+import pickle
+import zipfile
+import tempfile
+from xml.sax.saxutils import escape
 from .terminal_output import Terminal
 
 terminal = Terminal()
 
-class ExcelWriter():
-
-    def __init__(self, workbook_name):
-        self.wb_name = workbook_name
-        self.pending_processing = {}
-        self.pending_processing_tmp = {}
-        self.sorted_sheet_fields = {}
-
-    def create_workbook(self, data, structure):
-        # given the data as json and the structure as json too, create a workbook with this data
-
-        self.wb = Workbook()
-        # order the fields for proper display
-        for sheet_name, sheet_fields in list(structure.items()):
-            self.sorted_sheet_fields[sheet_name] = self.order_fields(sheet_fields)
-
-        self.pending_processing['main'] = {'data':data, 'is_processed': False}
-
-        # from the docs: https://docs.python.org/2.7/tutorial/datastructures.html#dictionaries
-        # It is sometimes tempting to change a list while you are looping over it;
-        # however, it is often simpler and safer to create a new list instead
-        # so lets not change the list while iterating
-        while len(list(self.pending_processing.keys())) != 0:
-            all_processed = True
-            for sheet_name, data in list(self.pending_processing.items()):
-                if data['is_processed'] == False:
-                    terminal.tprint('Processing '+ sheet_name, 'okblue')
-                    all_processed = False
-                    self.process_and_write(data['data'], sheet_name)
-                    # mark it as processed
-                    self.pending_processing[sheet_name]['is_processed'] = True
-                    break
-
-            if all_processed == True:
-                break
-
-        self.wb.save(self.wb_name)
-        return False
-
-    def process_and_write(self, data, sheet_name):
-        # contains 2D array of all the data for the current sheet
-        cur_records = []
-        cur_records.append(self.sorted_sheet_fields[sheet_name])
-
-        for record in data:
-            # contains 1D array of data for the current record data
-            this_record = []
-            for field in self.sorted_sheet_fields[sheet_name]:
-                try:
-                    cur_value = record[field]
-                except KeyError as e:
-                    cur_value = '-'
-
-                if isinstance(cur_value, list) == True:
-                    # defer processing
-                    if field not in self.pending_processing:
-                        terminal.tprint("\tFound new sheet (%s) data to save. Deferring for now." % field, 'warn')
-                        self.pending_processing[field] = {'data':[], 'is_processed': False}
-
-                    self.pending_processing[field]['data'].extend(cur_value)
-                    # add a link
-                    this_record.append('Check '+field)
-                else:
-                    this_record.append(cur_value)
-
-            cur_records.append(this_record)
-
-        # now lets do a batch write of our data
-        terminal.tprint("\tBatch writing of "+ sheet_name, 'ok')
-        self.wb.new_sheet(sheet_name, data = cur_records)
-
-
-    def order_fields(self, fields):
-        fields.sort()
-
-        # remove the parent_id if its there and append it at the begining
-        if 'parent_id' in fields:
-            fields.remove('parent_id')
-            fields.insert(0, 'parent_id')
-
-        if 'top_id' in fields:
-            fields.remove('top_id')
-            fields.insert(0, 'top_id')
-
-        fields.remove('unique_id')
-        fields.insert(0, 'unique_id')
-
-        return fields
\ No newline at end of file
+def order_fields(fields):
+    # sort the fields of a sheet, with the unique_id, top_id and parent_id at the begining
+    fields.sort()
+
+    # remove the parent_id if its there and append it at the begining
+    if 'parent_id' in fields:
+        fields.remove('parent_id')
+        fields.insert(0, 'parent_id')
+
+    if 'top_id' in fields:
+        fields.remove('top_id')
+        fields.insert(0, 'top_id')
+
+    fields.remove('unique_id')
+    fields.insert(0, 'unique_id')
+
+    return fields
+
+
+class SpooledSheets():
+    """
+    Spools (sheet_name, row) tuples to a temporary file per sheet, so the rows can be written sheet by sheet without holding them in memory
+    """
+    def __init__(self):
+        self.spools = {}
+
+    def spool_rows(self, rows):
+        # save the rows in a temporary file per sheet, returns the number of rows in the main sheet
+        main_rows = 0
+        for sheet_name, row in rows:
+            spool = self.add_spool(sheet_name)
+            pickle.dump(row, spool['file'], pickle.HIGHEST_PROTOCOL)
+            spool['count'] += 1
+            if sheet_name == 'main':
+                main_rows += 1
+
+        return main_rows
+
+    def add_spool(self, sheet_name):
+        # the spool of a sheet, which is created when the sheet is first found
+        if sheet_name not in self.spools:
+            self.spools[sheet_name] = {'file': tempfile.TemporaryFile(), 'count': 0}
+        return self.spools[sheet_name]
+
+    def sheet_names(self, structure):
+        # the main sheet, then the sheets in the order they were found, then the repeats which were always empty
+        sheet_names = ['main'] + [sheet_name for sheet_name in self.spools if sheet_name != 'main']
+        return sheet_names + [sheet_name for sheet_name in structure if sheet_name not in sheet_names]
+
+    def iter_spooled_rows(self, sheet_name):
+        spool = self.spools.get(sheet_name)
+        if spool is None:
+            return
+
+        spool['file'].seek(0)
+        for i in range(spool['count']):
+            yield pickle.load(spool['file'])
+
+    def spooled_size(self, sheet_name):
+        spool = self.spools.get(sheet_name)
+        return 0 if spool is None else spool['file'].seek(0, 2)
+
+    def iter_zip(self, parts, sheet_files, compression=zipfile.ZIP_DEFLATED, chunk_size=65536):
+        """
+        Generate a zip file as chunks of bytes, with the (file_name, data) parts followed by the (sheet_name, file_name, fields) sheet files
+
+        Each sheet is written to its file by write_sheet, and the written bytes are yielded once there are chunk_size of them.
+        The spools are closed once the zip file is generated
+        """
+        try:
+            output = StreamBuffer()
+            with zipfile.ZipFile(output, 'w', compression) as zip_file:
+                for file_name, data in parts:
+                    zip_file.writestr(file_name, data)
+                yield output.take()
+
+                for sheet_name, file_name, fields in sheet_files:
+                    terminal.tprint("\tStreaming the sheet " + sheet_name, 'ok')
+                    # the sizes of an entry are only known once it is written, so use zip64 for the large sheets
+                    is_large = self.spooled_size(sheet_name) > 2 ** 30
+                    with zip_file.open(file_name, 'w', force_zip64=is_large) as sheet_file:
+                        for _ in self.write_sheet(sheet_file, sheet_name, fields):
+                            if output.size() >= chunk_size:
+                                yield output.take()
+                    yield output.take()
+
+            yield output.take()
+        finally:
+            self.close()
+
+    def write_sheet(self, sheet_file, sheet_name, fields):
+        # write a spooled sheet to its file in the zip, yielding after each part of it
+        raise NotImplementedError
+
+    def close(self):
+        # the temporary files are deleted once they are closed
+        for spool in self.spools.values():
+            spool['file'].close()
+        self.spools = {}
+
+
+class StreamingExcelWriter(SpooledSheets):
+    """
+    Writes a workbook from (sheet_name, row) tuples without holding the data in memory
+
+    The rows are spooled to a temporary file per sheet, since the columns of a sheet are only known once all the rows have been
+    generated. The workbook is then generated sheet by sheet as a stream of bytes, so it can be sent to the client as it is written
+    """
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    # the characters which are not allowed in the XML of a sheet
+    illegal_xml_chars = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]')
+    # excel limits the length of a cell
+    max_cell_length = 32767
+
+    def iter_workbook(self, structure, chunk_size=65536):
+        """
+        Generate the workbook as chunks of bytes, with a sheet per sheet in the structure, starting with the main sheet
+        """
+        sheet_names = self.sheet_names(structure)
+        titles = self.sheet_titles(sheet_names)
+        parts = [
+            ('[Content_Types].xml', self.content_types_xml(len(sheet_names))),
+            ('_rels/.rels', self.package_rels_xml()),
+            ('xl/workbook.xml', self.workbook_xml(titles)),
+            ('xl/_rels/workbook.xml.rels', self.workbook_rels_xml(len(sheet_names))),
+            ('xl/styles.xml', self.styles_xml()),
+        ]
+        sheet_files = [(sheet_name, 'xl/worksheets/sheet%d.xml' % sheet_number, structure[sheet_name]) for sheet_number, sheet_name in enumerate(sheet_names, 1)]
+        return self.iter_zip(parts, sheet_files, zipfile.ZIP_DEFLATED, chunk_size)
+
+    def write_sheet(self, sheet_file, sheet_name, fields):
+        for data in self.iter_sheet_xml(sheet_name, fields):
+            sheet_file.write(data)
+            yield
+
+    def iter_sheet_xml(self, sheet_name, sheet_fields):
+        fields = order_fields(sheet_fields)
+        columns = [self.column_name(i) for i in range(len(fields))]
+        yield b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        yield b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        yield self.row_xml(1, columns, fields)
+
+        for row_number, row in enumerate(self.iter_spooled_rows(sheet_name), 2):
+            yield self.row_xml(row_number, columns, [row.get(field, '-') for field in fields])
+
+        yield b'</sheetData></worksheet>'
+
+    def row_xml(self, row_number, columns, values):
+        cells = []
+        for column, value in zip(columns, values):
+            cell_ref = '%s%d' % (column, row_number)
+            if value is None:
+                continue
+            elif isinstance(value, bool):
+                cells.append('<c r="%s" t="b"><v>%d</v></c>' % (cell_ref, value))
+            elif isinstance(value, (int, float)) and math.isfinite(value):
+                cells.append('<c r="%s"><v>%r</v></c>' % (cell_ref, value))
+            else:
+                value = self.illegal_xml_chars.sub('', str(value))[:self.max_cell_length]
+                cells.append('<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (cell_ref, escape(value)))
+
+        return ('<row r="%d">%s</row>' % (row_number, ''.join(cells))).encode('utf-8')
+
+    def column_name(self, index):
+        # the excel name of a column, eg A, Z, AA
+        name = ''
+        index += 1
+        while index > 0:
+            (index, remainder) = divmod(index - 1, 26)
+            name = chr(65 + remainder) + name
+        return name
+
+    def sheet_titles(self, sheet_names):
+        # the sheet titles can't have some characters, are at most 31 characters long and should be unique
+        # excel compares the titles case insensitively, so the names which are the same once cut get a numeric suffix
+        titles = []
+        used_titles = set()
+        for sheet_name in sheet_names:
+            base_title = re.sub(r'[\[\]:*?/\\]', '_', sheet_name) or 'sheet'
+            title = base_title[:31]
+            suffix = 1
+            while title.lower() in used_titles:
+                suffix += 1
+                title = '%s_%d' % (base_title[:31 - len(str(suffix)) - 1], suffix)
+            titles.append(title)
+            used_titles.add(title.lower())
+        return titles
+
+    def content_types_xml(self, sheets_count):
+        sheets = ''.join('<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' % i for i in range(1, sheets_count + 1))
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+                '%s</Types>' % sheets)
+
+    def package_rels_xml(self):
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+                '</Relationships>')
+
+    def workbook_xml(self, titles):
+        sheets = ''.join('<sheet name="%s" sheetId="%d" r:id="rId%d"/>' % (escape(title, {'"': '&quot;'}), i, i) for i, title in enumerate(titles, 1))
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                '<sheets>%s</sheets></workbook>' % sheets)
+
+    def workbook_rels_xml(self, sheets_count):
+        sheets = ''.join('<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%d.xml"/>' % (i, i) for i in range(1, sheets_count + 1))
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">%s'
+                '<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+                '</Relationships>' % (sheets, sheets_count + 1))
+
+    def styles_xml(self):
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+                '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+                '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+                '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+                '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+                '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+                '</styleSheet>')
+
+
+class StreamBuffer():
+    """
+    A write only file which keeps the written bytes until they are taken, for writing a zip file to a stream
+    """
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.length += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return self.length
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.length = 0
+        return data
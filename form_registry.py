@@ -0,0 +1,194 @@
+"""A process-wide registry of the forms
+
+Holds the settings of the forms from forms_settings.ini, ie the form groups, the metadata fields and keys of each form and the
+country codes, together with the forms registered in the database. The settings are loaded once and reloaded when the file is
+modified, while the forms are reloaded after FORM_REGISTRY_TTL seconds or when they are invalidated
+"""
+import os
+import re
+import time
+import threading
+
+from configparser import ConfigParser
+
+from django.conf import settings
+
+from .models import ODKForm
+from .caches import LRUCache
+
+
+class CountryMatcher():
+    """
+    Resolves a country code to its country name
+
+    A code which isn't defined is matched against the defined codes as case insensitive regular expressions, and the country of
+    the first code in the settings which matches anywhere in it is used. The codes are compiled into one regular expression, and
+    the resolved codes are memoised
+    """
+    def __init__(self, country_codes, memo_size=10000):
+        self.country_codes = country_codes
+        self.resolved = LRUCache(memo_size)
+
+        # each code is a lookahead from the start of the input followed by an empty named group, so the alternatives are
+        # tried in the order of the codes and the name of the matched group identifies the code
+        self.countries = []
+        self.patterns = []
+        alternatives = []
+        for c_code, country in country_codes.items():
+            try:
+                self.patterns.append(re.compile(c_code, re.IGNORECASE))
+            except re.error:
+                # an invalid code can't match any input
+                continue
+            alternatives.append(r"(?=[\s\S]*?(?:%s))(?P<c%d>)" % (c_code, len(self.countries)))
+            self.countries.append(country)
+
+        try:
+            self.matcher = re.compile('|'.join(alternatives), re.IGNORECASE) if len(alternatives) != 0 else None
+        except re.error:
+            # the codes can't be combined, eg they use inline flags, so search for them one at a time
+            self.matcher = None
+
+    def resolve(self, code):
+        """
+        Get the country of the code, or the code itself when it doesn't match any defined code
+        """
+        if not isinstance(code, str):
+            # the values which aren't strings can only be exact codes
+            try:
+                return self.country_codes.get(code, code)
+            except TypeError:
+                return code
+
+        (is_found, country) = self.resolved.lookup(code)
+        if is_found:
+            return country
+
+        if code in self.country_codes:
+            country = self.country_codes[code]
+        elif self.matcher is not None:
+            m = self.matcher.match(code)
+            country = code if m is None else self.countries[int(m.lastgroup[1:])]
+        else:
+            country = next((self.countries[i] for i, pattern in enumerate(self.patterns) if pattern.search(code) is not None), code)
+
+        self.resolved.set(code, country)
+        return country
+
+
+class FormRegistry():
+    def __init__(self, settings_file, ttl=None):
+        self.settings_file = settings_file
+        self.ttl = ttl if ttl is not None else getattr(settings, 'FORM_REGISTRY_TTL', 300)
+        self.lock = threading.Lock()
+        self.settings_mtime = None
+        self.is_loaded = False
+        self.forms = None
+        self.forms_loaded_at = None
+
+    def check_settings(self):
+        # reload the settings when forms_settings.ini has been modified since they were loaded
+        try:
+            settings_mtime = os.path.getmtime(self.settings_file)
+        except OSError:
+            settings_mtime = None
+
+        with self.lock:
+            if not self.is_loaded or settings_mtime != self.settings_mtime:
+                self.load_settings()
+                self.settings_mtime = settings_mtime
+                self.is_loaded = True
+
+    def load_settings(self):
+        parser = ConfigParser()
+        parser.read(self.settings_file)
+
+        # the group and the settings of each form section, eg id_123
+        self.form_groups = {}
+        self.form_settings = {}
+        for section in parser.sections():
+            try:
+                self.form_groups[section] = parser.get(section, 'form_group')
+            except Exception:
+                pass
+
+            try:
+                self.form_settings[section] = (parser.get(section, 'metadata').split(','), parser.get(section, 'pk_name'), parser.get(section, 'sk_name'))
+            except Exception:
+                pass
+
+        # the forms and the name of each group. The forms of a group can only be determined when all the sections have a form_group
+        self.group_forms = {}
+        for form_group in set(self.form_groups.values()):
+            try:
+                associated_forms = []
+                for section in parser.sections():
+                    if parser.get(section, 'form_group') == form_group:
+                        m = re.findall(r"/?id_(\d+)$", section)
+                        associated_forms.append(m[0])
+                self.group_forms[form_group] = (associated_forms, parser.get(form_group, 'name'))
+            except Exception:
+                pass
+
+        # the country codes mapped to the country names, a country can have several comma separated codes
+        country_codes = {}
+        self.country_matcher = None
+        self.country_codes_error = None
+        try:
+            for country, c_code in parser.items('countries'):
+                for t_code in c_code.split(','):
+                    country_codes[t_code] = country
+            self.country_matcher = CountryMatcher(country_codes)
+        except Exception as e:
+            self.country_codes_error = str(e)
+
+    def get_form_group(self, form_id):
+        """
+        Get the group of a form, or None if the form doesn't have a group
+        """
+        self.check_settings()
+        return self.form_groups.get('id_' + str(form_id))
+
+    def get_group_forms(self, form_group):
+        """
+        Get a tuple (associated_forms, group_name) of a form group, or None if the forms of the group can't be determined
+        """
+        self.check_settings()
+        group_forms = self.group_forms.get(form_group)
+        return None if group_forms is None else (list(group_forms[0]), group_forms[1])
+
+    def get_form_settings(self, form_id):
+        """
+        Get a tuple (metadata, pk_name, sk_name) of a form, or None if the form settings haven't been defined
+        """
+        self.check_settings()
+        form_settings = self.form_settings.get('id_' + str(form_id))
+        return None if form_settings is None else (list(form_settings[0]), form_settings[1], form_settings[2])
+
+    def get_country_matcher(self):
+        """
+        Get the matcher of the country codes. Raises an exception if the countries are not defined
+        """
+        self.check_settings()
+        if self.country_codes_error is not None:
+            raise Exception(self.country_codes_error)
+
+        return self.country_matcher
+
+    def get_forms(self):
+        """
+        Get the forms registered in the database, ordered by their id
+        """
+        with self.lock:
+            if self.forms is None or time.monotonic() - self.forms_loaded_at > self.ttl:
+                self.forms = list(ODKForm.objects.order_by('id').values('id', 'form_id', 'form_name', 'full_form_id', 'is_source_deleted'))
+                self.forms_loaded_at = time.monotonic()
+
+            return self.forms
+
+    def invalidate_forms(self):
+        with self.lock:
+            self.forms = None
+
+
+form_registry = FormRegistry(os.path.join(os.path.dirname(__file__), 'forms_settings.ini'))
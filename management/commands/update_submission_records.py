@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
+from livhealth_scripts.models import ODKForm
 from livhealth_scripts.odk_choices_parser import ImportODKChoices, UpdateDatabase
+from livhealth_scripts.odk_forms import OdkForms
 
 
 class Command(BaseCommand):
@@ -12,8 +14,44 @@ class Command(BaseCommand):
             help='Update the record of the SCVO who submitted the record. This info is included in the data collection forms but it is currently not being processed',
         )
 
+        parser.add_argument(
+            '--reconcile_submissions',
+            action='store_true',
+            help='Download again the saved submissions which have been edited on onadata and mark the ones deleted on onadata',
+        )
+
+        parser.add_argument(
+            '--full_sync',
+            action='store_true',
+            help='List all the submissions of the forms on onadata and download the ones which are missing from the database',
+        )
+
+        parser.add_argument(
+            '--backfill_forms',
+            nargs='*',
+            type=int,
+            metavar='FORM_ID',
+            help='Download the structures, metadata and submissions of the given forms at once, or of all the forms on onadata when no form id is given',
+        )
+
     def handle(self, *args, **options):
 
         if options['update_submitters_records']:
             updater = UpdateDatabase()
             updater.update_syndromic_submitter()
+
+        if options['reconcile_submissions']:
+            odk_forms = OdkForms()
+            for form_id in ODKForm.objects.filter(is_source_deleted=False).values_list('form_id', flat=True):
+                odk_forms.get_all_submissions(form_id, 'reconcile')
+
+        if options['full_sync']:
+            odk_forms = OdkForms()
+            for form_id in ODKForm.objects.filter(is_source_deleted=False).values_list('form_id', flat=True):
+                odk_forms.get_all_submissions(form_id, 'full')
+
+        if options['backfill_forms'] is not None:
+            odk_forms = OdkForms()
+            failed_ids = odk_forms.backfill_forms(options['backfill_forms'] or None)
+            if len(failed_ids) != 0:
+                raise CommandError('The forms %s could not be backfilled' % ', '.join(str(form_id) for form_id in failed_ids))
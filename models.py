@@ -65,6 +65,16 @@ class ODKForm(BaseTable):
     processed_structure = JSONField(null=True)
     auto_update = models.BooleanField(default=False)
     is_source_deleted = models.BooleanField(default=False)
+    # the sync watermark, ie the last submission pulled from onadata
+    last_synced_id = models.IntegerField(null=True)
+    last_synced_time = models.CharField(max_length=100, null=True)
+    # the submissions metadata from the onadata forms list, and the last submission time when the form was last synced
+    num_of_submissions = models.IntegerField(null=True)
+    last_submission_time = models.CharField(max_length=100, null=True)
+    synced_submission_time = models.CharField(max_length=100, null=True)
+    # the version of the saved structure, and the latest version of the form from the onadata forms list
+    form_version = models.CharField(max_length=100, null=True)
+    latest_version = models.CharField(max_length=100, null=True)
 
     class Meta:
         db_table = 'odkform'
@@ -76,12 +86,33 @@ class ODKForm(BaseTable):
         return self.id
 
 
+class OnaRequestCache(BaseTable):
+    # the validators of the last processed response of an onadata url, used to make conditional requests
+    url = models.CharField(max_length=500, unique=True)
+    etag = models.CharField(max_length=200, null=True)
+    last_modified = models.CharField(max_length=100, null=True)
+    content_hash = models.CharField(max_length=64, null=True)
+
+    class Meta:
+        db_table = 'ona_request_cache'
+
+    def publish(self):
+        self.save()
+
+    def get_id(self):
+        return self.url
+
+
 class RawSubmissions(BaseTable):
     # Define the structure of the submission table
     form = models.ForeignKey(ODKForm, on_delete=models.PROTECT)
     uuid = models.CharField(max_length=100, unique=True)
     submission_time = models.CharField(max_length=100)
     raw_data = JSONField()
+    # used to reconcile the saved submissions with the edits and deletions done on onadata
+    content_hash = models.CharField(max_length=64, null=True)
+    last_edited = models.CharField(max_length=100, null=True)
+    is_deleted = models.BooleanField(default=False)
 
     class Meta:
         db_table = 'raw_submissions'
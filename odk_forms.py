@@ -1,13 +1,19 @@
-import requests, re, os, sys
+import re, os, sys
 import logging, traceback, json
-import copy
-import subprocess
 import hashlib
 import dateutil.parser
 import math
 import time
 import shutil
+import io
 import csv
+import string
+import functools
+import itertools
+import threading
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from raven import Client
 
@@ -17,7 +23,7 @@ from datetime import datetime, date, timedelta
 from django.utils import timezone
 from django.conf import settings
 from django.http import HttpResponse, HttpRequest
-from django.db import IntegrityError, connection
+from django.db import IntegrityError, connection, transaction
 from django.db.models import Q
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
@@ -25,12 +31,18 @@ from django.core.exceptions import SuspiciousOperation
 
 from django.template import Context
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from django.core import serializers
 
 from .terminal_output import Terminal
-from .excel_writer import ExcelWriter
+from .excel_writer import StreamingExcelWriter, order_fields
+from .archive_writer import SheetArchiveWriter
+from .columnar import flatten_submissions
+from .column_types import view_column_types, parse_column_value
+from .form_registry import form_registry
+from .caches import dictionary_cache, form_structures_cache, flatten_plans_cache
+from .ona_client import get_ona_client, AsyncOnaClient, iter_json_array, iter_response_text, iter_text_lines
 from .models import *
 from .sql import Query
 
@@ -71,6 +83,10 @@ class OdkForms():
         self.form_rep = 'api/v1/forms/'
         self.media = 'api/v1/media'
         self.metadata_uri = 'api/v1/metadata'
+        # the number of full submissions to download per request, the pages are streamed and saved in batches
+        self.submissions_page_size = 5000
+        self.submissions_batch_size = 500
+        self.client = get_ona_client()
 
         self.project = settings.PROJECT_NAME
         self.county_name = settings.COUNTY_NAME
@@ -79,12 +95,14 @@ class OdkForms():
         self.cur_node_id = None
         self.form_group = None
         self.cur_form_id = None
+        # the dictionary items collected while processing a form structure, keyed by (form_id, t_key)
+        self.pending_dictionary_items = {}
 
         # to avoid errors when running the cron jobs, construct an absolute path to the settings file
         self.forms_settings = os.path.join(os.path.dirname(__file__), 'forms_settings.ini')
         self.form_connection = None
         self.country_qsts = ['c1s1q8_Country_name']
-        self.clean_country_codes = None
+        self.country_matcher = None
 
         self.email_message_inner_template = """
         <p>
@@ -144,32 +162,38 @@ class OdkForms():
         return to_return
 
     def get_value_from_dictionary(self, t_key, update_dict=True):
-        query = """
-            SELECT t_value from dictionary_items where t_key = '%s'
-        """ % t_key
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            t_value = cursor.fetchall()
-            try:
-                return str(t_value[0][0])
-            except IndexError as e:
-                # We need to process all the form's structure which have a defined structure. We have all this data, so returning an unknown value is not smart
-                terminal.tprint("Couldn't find the value for the key '%s' in the dictionary -- Updating the dictionary %s" % (t_key, str(e)), 'fail')
-                # to avoid cyclic repetition, check if we need to update the dictionary
-                if update_dict:
-                    # default for now
-                    return str(t_key)
-                    dict_value = self.update_dictionary_items(t_key)
-                    if dict_value is None:
-                        terminal.tprint("Even after the dictionary update, couldn't find the value for the key '%s' in the dictionary. Giving up. %s" % (t_key, str(e)), 'fail')
-                        return str(t_key)
-                    else:
-                        return str(dict_value)
-                else:
-                    return None
-            except Exception as e:
-                terminal.tprint("Couldn't find the value for the key '%s' in the dictionary. %s" % (t_key, str(e)), 'fail')
-                return str(t_key)
+        try:
+            t_value = dictionary_cache.get(t_key)
+        except Exception as e:
+            terminal.tprint("Couldn't find the value for the key '%s' in the dictionary. %s" % (t_key, str(e)), 'fail')
+            return str(t_key)
+
+        if t_value is not None:
+            return str(t_value)
+
+        # We need to process all the form's structure which have a defined structure. We have all this data, so returning an unknown value is not smart
+        terminal.tprint("Couldn't find the value for the key '%s' in the dictionary" % t_key, 'fail')
+        # to avoid cyclic repetition, check if we need to update the dictionary
+        if update_dict:
+            # default for now
+            return str(t_key)
+        else:
+            return None
+
+    def get_values_from_dictionary(self, t_keys):
+        """
+        Resolve several keys from the dictionary in one go
+
+        Returns a mapping of each key to its value, with keys which are not in the dictionary mapped to themselves
+        """
+        t_keys = [t_key for t_key in set(t_keys) if t_key is not None]
+        try:
+            t_values = dictionary_cache.get_many(t_keys)
+        except Exception as e:
+            terminal.tprint("Couldn't resolve the keys from the dictionary. %s" % str(e), 'fail')
+            t_values = {}
+
+        return {t_key: str(t_key) if t_values.get(t_key) is None else str(t_values[t_key]) for t_key in t_keys}
 
     def update_dictionary_items(self, t_key=None):
         """
@@ -187,63 +211,140 @@ class OdkForms():
                     for choice in form['structure']['choices'][choice_name]:
                         self.add_dictionary_items(choice, 'choice')
 
-                return self.get_value_from_dictionary(t_key, False)
+                self.save_dictionary_items()
+
             # restore the form_id backup
             self.cur_form_id = form_id_bkup
+            return self.get_value_from_dictionary(t_key, False)
         except Exception as e:
             terminal.tprint(str(e), 'fail')
             # restore the form_id backup
             self.cur_form_id = form_id_bkup
+            self.pending_dictionary_items = {}
             return None
 
-    def refresh_forms(self):
+    def refresh_forms(self, process_structures='background'):
         """
         Refresh the list of forms in the database
+
+        The new forms are registered in one insert. The structures of the new forms and of the forms which have been
+        republished with a new version are then processed in a background thread, or inline when process_structures is 'inline'
         """
         url = "%s/%s" % (self.server, self.api_all_forms)
-        all_forms = self.process_curl_request(url)
-        if all_forms is None:
+        (is_modified, r) = self.process_conditional_request(url)
+        if r is None:
             print(("Error while executing the API request %s" % url))
             return
 
+        if not is_modified:
+            terminal.tprint("The list of forms hasn't changed since the last refresh", 'ok')
+            return self.get_saved_forms()
+
+        all_forms = r.json()
+        # get all the forms which are already saved in the database, without their structures
+        saved_forms = {}
+        for saved_form in ODKForm.objects.filter(full_form_id__in=[form['id_string'] for form in all_forms]).only('id', 'form_id', 'form_name', 'full_form_id', 'num_of_submissions', 'last_submission_time', 'latest_version'):
+            saved_forms[saved_form.full_form_id] = saved_form
+
         to_return = []
         to_return.append({'title': 'Select One', 'id': '-1'})
+        new_forms = []
+        updated_forms = []
+        republished_form_ids = []
         for form in all_forms:
-            # check whether the form is already saved in the database
-            try:
-                saved_form = ODKForm.objects.get(full_form_id=form['id_string'])
-                terminal.tprint("The form '%s' is already saved in the database" % saved_form.form_name, 'ok')
-                to_return.append({'title': saved_form.form_name, 'id': saved_form.form_id, 'full_id': form['id_string']})
-            except ODKForm.DoesNotExist as e:
+            saved_form = saved_forms.get(form['id_string'])
+            form_version = self.listed_form_version(form)
+            if saved_form is None:
                 # this form is not saved in the database, so save it
                 terminal.tprint("The form '%s' is not in the database, saving it" % form['id_string'], 'warn')
-                cur_form = ODKForm(
+                new_forms.append(ODKForm(
                     form_id=form['formid'],
                     form_name=form['title'],
                     full_form_id=form['id_string'],
                     auto_update=False,
-                    is_source_deleted=False
-                )
-                cur_form.publish()
-                # lets process the form structure, for forms that are being added dynamically
-                self.get_form_structure_as_json(cur_form.form_id)
+                    is_source_deleted=False,
+                    num_of_submissions=form.get('num_of_submissions'),
+                    last_submission_time=form.get('last_submission_time'),
+                    latest_version=form_version
+                ))
                 to_return.append({'title': form['title'], 'id': form['formid'], 'full_id': form['id_string']})
-            except Exception as e:
-                terminal.tprint(str(e), 'fail')
-                sentry.captureException()
+            else:
+                if saved_form.latest_version is not None and saved_form.latest_version != form_version:
+                    # the form has been republished, so its structure needs to be processed again
+                    terminal.tprint("The form '%s' has a new version, '%s'" % (form['id_string'], form_version), 'warn')
+                    republished_form_ids.append(saved_form.form_id)
+
+                if saved_form.num_of_submissions != form.get('num_of_submissions') or saved_form.last_submission_time != form.get('last_submission_time') or saved_form.latest_version != form_version:
+                    saved_form.num_of_submissions = form.get('num_of_submissions')
+                    saved_form.last_submission_time = form.get('last_submission_time')
+                    saved_form.latest_version = form_version
+                    updated_forms.append(saved_form)
+                to_return.append({'title': saved_form.form_name, 'id': saved_form.form_id, 'full_id': form['id_string']})
 
+        try:
+            ODKForm.objects.bulk_create(new_forms, ignore_conflicts=True)
+            ODKForm.objects.bulk_update(updated_forms, ['num_of_submissions', 'last_submission_time', 'latest_version'])
+            if len(new_forms) != 0:
+                form_registry.invalidate_forms()
+        except Exception as e:
+            terminal.tprint(str(e), 'fail')
+            sentry.captureException()
+            return to_return
+
+        if len(new_forms) != 0 or len(republished_form_ids) != 0:
+            # lets process the form structure, for forms that are being added dynamically or have been republished
+            form_ids = [new_form.form_id for new_form in new_forms] + republished_form_ids
+            if process_structures == 'inline':
+                process_forms_structures(form_ids)
+            elif process_structures == 'background':
+                threading.Thread(target=process_forms_structures, args=(form_ids,), name='process_forms_structures').start()
+
+        self.save_request_validators(url, r)
         return to_return
 
-    def get_all_submissions(self, form_id):
+    def listed_form_version(self, form):
+        # the version of a form in the onadata forms list. The hash of the XForm changes whenever the form is republished,
+        # while the version only changes when it is set in the form
+        return form.get('hash') or form.get('version')
+
+    def get_saved_forms(self):
+        # get the list of forms saved in the database, in the format returned by refresh_forms
+        to_return = []
+        to_return.append({'title': 'Select One', 'id': '-1'})
+        for form in form_registry.get_forms():
+            if form['is_source_deleted']:
+                continue
+            to_return.append({'title': form['form_name'], 'id': form['form_id'], 'full_id': form['full_form_id']})
+
+        return to_return
+
+    def get_all_submissions(self, form_id, sync_mode='incremental', raise_errors=False):
         """
         Given a form id, get all the submitted data
+
+        In the 'incremental' sync mode, only the submissions past the form's sync watermark are requested from onadata.
+        The 'full' sync mode asks for all the submission ids of the form and is used to recover missing submissions.
+        The 'reconcile' sync mode does an incremental sync after refreshing the edited submissions and marking the deleted ones.
+        The errors are logged, and re-raised when raise_errors is True so that the caller knows the sync failed
         """
         try:
             # the form_id used in odk_forms and submissions is totally different
             terminal.tprint("Processing form with form-id %d" % form_id, 'debug')
             odk_form = ODKForm.objects.get(form_id=form_id)
-            submissions = RawSubmissions.objects.filter(form_id=odk_form.id).values('raw_data')
-            submitted_instances = self.online_submissions_count(form_id)
+            submissions = RawSubmissions.objects.filter(form_id=odk_form.id, is_deleted=False).values('raw_data')
+            if form_id in synced_forms:
+                # the submissions have already been synced in the current processing run
+                terminal.tprint("\t'%s': Submissions already synced in this run" % odk_form.form_name, 'info')
+                return submissions if submissions.count() != 0 else None
+
+            if sync_mode == 'reconcile':
+                self.reconcile_submissions(odk_form)
+
+            if odk_form.num_of_submissions is not None:
+                # use the submissions count saved from the forms list when the forms were refreshed
+                submitted_instances = odk_form.num_of_submissions
+            else:
+                submitted_instances = self.online_submissions_count(form_id)
 
             # check whether all the submissions from the db match the online submissions
             if submitted_instances is None:
@@ -255,36 +356,48 @@ class OdkForms():
                 terminal.tprint('\tNo submisions to process', 'fail')
                 return None
 
-            if submitted_instances > submissions.count():
+            if submitted_instances > submissions.count() or odk_form.last_submission_time != odk_form.synced_submission_time:
                 # we have some new submissions, so fetch them from the server and save them offline
                 terminal.tprint("\tWe have some new submissions, so fetch them from the server and save them offline", 'info')
-                # fetch the submissions and filter by submission time
-                url = "%s/%s%d.json?start=1&limit=5&sort=%s" % (self.server, self.form_data, form_id, '{"_submission_time":-1}')
-                url = "%s/%s%d.json?fields=[\"_uuid\", \"_id\"]" % (self.server, self.form_data, form_id)
-                submission_uuids = self.process_curl_request(url)
-
-                for uuid in submission_uuids:
-                    # check if the current uuid is saved in the database
-                    cur_submission = RawSubmissions.objects.filter(form_id=odk_form.id, uuid=uuid['_uuid'])
-                    if cur_submission.count() == 0:
-                        # the current submission is not saved in the database, so fetch and save it...
-                        url = "%s/%s%d/%s" % (self.server, self.form_data, form_id, uuid['_id'])
-                        submission = self.process_curl_request(url)
-
-                        t_submission = RawSubmissions(
-                            form_id=odk_form.id,
-                            uuid=submission['_uuid'],
-                            submission_time=submission['_submission_time'],
-                            raw_data=submission
-                        )
-                        t_submission.publish()
-                    else:
-                        # the current submission is already saved, so stop the processing
-                        # terminal.tprint("The current submission is already saved, implying that all submissions have been processed, so stop the processing!", 'fail')
-                        continue
+                if sync_mode != 'full' and odk_form.last_synced_id is not None:
+                    terminal.tprint("\tFetching the submissions after the submission with _id %d" % odk_form.last_synced_id, 'info')
+                    self.fetch_submissions_in_bulk(odk_form, {'_id': {'$gt': odk_form.last_synced_id}})
+                else:
+                    # list all the submission ids and download the pages from the earliest missing submission
+                    submission_uuids = self.fetch_submission_ids(form_id)
+                    if submission_uuids is None:
+                        raise Exception("There was an error while fetching the submission ids of the form '%s'" % odk_form.form_name)
+
+                    min_missing_id = None
+                    missing_uuids = []
+                    last_submission = None
+                    for uuids_batch in self.iter_batches(submission_uuids, self.submissions_batch_size):
+                        saved_uuids = self.saved_submission_uuids(odk_form, [uuid['_uuid'] for uuid in uuids_batch])
+                        for uuid in uuids_batch:
+                            if uuid['_uuid'] not in saved_uuids:
+                                missing_uuids.append(uuid['_uuid'])
+                                if min_missing_id is None or int(uuid['_id']) < min_missing_id:
+                                    min_missing_id = int(uuid['_id'])
+                        last_submission = uuids_batch[-1]
+
+                    if min_missing_id is not None:
+                        self.fetch_submissions_in_bulk(odk_form, {'_id': {'$gte': min_missing_id}})
+
+                    # only move the watermark to the last listed submission when all the listed submissions are saved
+                    still_missing = 0
+                    for uuids_batch in self.iter_batches(missing_uuids, self.submissions_batch_size):
+                        still_missing += len(set(uuids_batch) - self.saved_submission_uuids(odk_form, uuids_batch))
+                    if still_missing != 0:
+                        raise Exception("%d submissions of the form '%s' are still missing after the full sync" % (still_missing, odk_form.form_name))
+
+                    if last_submission is not None:
+                        self.update_sync_watermark(odk_form, [last_submission])
+
+                odk_form.synced_submission_time = odk_form.last_submission_time
+                odk_form.save(update_fields=['synced_submission_time'])
 
                 # just check if all is now ok
-                submissions = RawSubmissions.objects.filter(form_id=odk_form.id).order_by('submission_time').values('raw_data')
+                submissions = RawSubmissions.objects.filter(form_id=odk_form.id, is_deleted=False).order_by('submission_time').values('raw_data')
                 if submissions.count() != submitted_instances:
                     # ok, still the processing is not complete... shout!
                     terminal.tprint("Even after processing submitted responses for '%s', the tally doesn't match (%d vs %d)!" % (odk_form.form_name, submissions.count(), submitted_instances), 'error')
@@ -295,14 +408,162 @@ class OdkForms():
 
         except ODKForm.DoesNotExist as e:
             terminal.tprint("The form with form_id %d does not exits. Probably not saved in the database" % form_id, 'error')
+            if raise_errors:
+                raise
             return None
         except Exception as e:
             logger.error('Some error....')
             logger.error(str(e))
             terminal.tprint(str(e), 'error')
+            if raise_errors:
+                raise
 
         return submissions
 
+    def fetch_submission_ids(self, form_id, query=None):
+        """
+        Get the _uuid, _id and _submission_time of the form submissions, ordered by the submission _id
+
+        If a query is given, eg {"_id": {"$gt": 100}}, only the submissions matching the query are listed.
+        The ids are streamed, so an iterator is returned, or None if the request failed
+        """
+        url = "%s/%s%d.json?fields=%s&sort=%s" % (self.server, self.form_data, form_id, json.dumps(['_uuid', '_id', '_submission_time']), json.dumps({'_id': 1}))
+        if query is not None:
+            url = "%s&query=%s" % (url, json.dumps(query))
+
+        return self.process_streamed_request(url)
+
+    def fetch_submissions_in_bulk(self, odk_form, query=None):
+        """
+        Download the full submissions of a form page by page and save them in batches, each with a single insert
+
+        The pages are parsed as they are received, so only a batch of submissions is held in memory at a time.
+        Submissions which are already saved are ignored. Returns the number of downloaded submissions, and raises an exception
+        when a page can't be fetched, so that the sync watermark is never moved past a missing page
+        """
+        downloaded = 0
+        page = 1
+        while True:
+            url = "%s/%s%d.json?page=%d&page_size=%d&sort=%s" % (self.server, self.form_data, odk_form.form_id, page, self.submissions_page_size, json.dumps({'_id': 1}))
+            if query is not None:
+                url = "%s&query=%s" % (url, json.dumps(query))
+
+            terminal.tprint("\tFetching page %d of the '%s' submissions" % (page, odk_form.form_name), 'info')
+            # onadata responds with a 404 when we go past the last page, any other failure would leave a gap in the submissions
+            cur_page = self.process_streamed_request(url, is_missing_empty=True)
+            if cur_page is None:
+                raise Exception("There was an error while fetching the page %d of the '%s' submissions" % (page, odk_form.form_name))
+
+            page_count = 0
+            for submissions_batch in self.iter_batches(cur_page, self.submissions_batch_size):
+                RawSubmissions.objects.bulk_create([self.raw_submission(odk_form, submission) for submission in submissions_batch], ignore_conflicts=True)
+                self.update_sync_watermark(odk_form, submissions_batch)
+                page_count += len(submissions_batch)
+
+            downloaded += page_count
+            if page_count < self.submissions_page_size:
+                break
+            page += 1
+
+        return downloaded
+
+    def raw_submission(self, odk_form, submission):
+        # create a raw submission record from a submission downloaded from onadata
+        return RawSubmissions(
+            form_id=odk_form.id,
+            uuid=submission['_uuid'],
+            submission_time=submission['_submission_time'],
+            raw_data=submission,
+            content_hash=hashlib.sha1(json.dumps(submission, sort_keys=True).encode('utf-8')).hexdigest(),
+            last_edited=submission.get('_last_edited')
+        )
+
+    def reconcile_submissions(self, odk_form):
+        """
+        Reconcile the saved submissions of a form with the edits and deletions done on onadata
+
+        Only the _id, _uuid and _last_edited of the submissions are listed. The submissions edited since they were saved are
+        downloaded again and the saved submissions which are no longer on onadata are marked as deleted
+        """
+        terminal.tprint("\tReconciling the saved submissions of '%s'" % odk_form.form_name, 'info')
+        url = "%s/%s%d.json?fields=%s" % (self.server, self.form_data, odk_form.form_id, json.dumps(['_id', '_uuid', '_last_edited']))
+        online_submissions = self.process_streamed_request(url)
+        if online_submissions is None:
+            raise Exception("There was an error while listing the submissions of the form '%s'" % odk_form.form_name)
+
+        saved_submissions = {}
+        for uuid, last_edited, is_deleted in RawSubmissions.objects.filter(form_id=odk_form.id).values_list('uuid', 'last_edited', 'is_deleted').iterator():
+            saved_submissions[uuid] = (last_edited, is_deleted)
+
+        edited_ids = []
+        for submission in online_submissions:
+            if submission['_uuid'] not in saved_submissions:
+                # a new submission, it will be downloaded by the normal sync
+                continue
+
+            (last_edited, is_deleted) = saved_submissions.pop(submission['_uuid'])
+            if is_deleted or last_edited != submission.get('_last_edited'):
+                edited_ids.append(submission['_id'])
+
+        # whatever is left was deleted on onadata
+        deleted_uuids = [uuid for uuid, (last_edited, is_deleted) in saved_submissions.items() if not is_deleted]
+        for uuids_batch in self.iter_batches(deleted_uuids, self.submissions_batch_size):
+            RawSubmissions.objects.filter(form_id=odk_form.id, uuid__in=uuids_batch).update(is_deleted=True)
+
+        terminal.tprint("\t'%s': %d edited and %d deleted submissions" % (odk_form.form_name, len(edited_ids), len(deleted_uuids)), 'info')
+        for ids_batch in self.iter_batches(edited_ids, self.submissions_batch_size):
+            urls = ["%s/%s%d/%s" % (self.server, self.form_data, odk_form.form_id, _id) for _id in ids_batch]
+            edited_submissions = {}
+            for submission in self.process_curl_requests(urls):
+                if submission is not None:
+                    edited_submissions[submission['_uuid']] = self.raw_submission(odk_form, submission)
+
+            to_update = []
+            for saved in RawSubmissions.objects.filter(form_id=odk_form.id, uuid__in=list(edited_submissions.keys())):
+                edited = edited_submissions[saved.uuid]
+                saved.is_deleted = False
+                saved.last_edited = edited.last_edited
+                if saved.content_hash != edited.content_hash:
+                    saved.raw_data = edited.raw_data
+                    saved.submission_time = edited.submission_time
+                    saved.content_hash = edited.content_hash
+                to_update.append(saved)
+
+            RawSubmissions.objects.bulk_update(to_update, ['raw_data', 'submission_time', 'content_hash', 'last_edited', 'is_deleted'])
+
+    def iter_batches(self, items, batch_size):
+        # group the items of an iterable in lists of batch_size items
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if len(batch) != 0:
+            yield batch
+
+    def saved_submission_uuids(self, odk_form, uuids, batch_size=1000):
+        # get the subset of the uuids which are already saved in the database, querying them in batches
+        saved_uuids = set()
+        for i in range(0, len(uuids), batch_size):
+            saved_uuids.update(RawSubmissions.objects.filter(form_id=odk_form.id, uuid__in=uuids[i:i + batch_size]).values_list('uuid', flat=True))
+
+        return saved_uuids
+
+    def update_sync_watermark(self, odk_form, submission_uuids):
+        # move the sync watermark of the form to the last submission that we have seen
+        if len(submission_uuids) == 0:
+            return
+
+        last_submission = max(submission_uuids, key=lambda x: int(x['_id']))
+        if odk_form.last_synced_id is not None and int(last_submission['_id']) <= odk_form.last_synced_id:
+            return
+
+        odk_form.last_synced_id = int(last_submission['_id'])
+        odk_form.last_synced_time = last_submission.get('_submission_time')
+        odk_form.save(update_fields=['last_synced_id', 'last_synced_time'])
+
     def online_submissions_count(self, form_id):
         # given a form id, process the number of submitted instances
         # terminal.tprint("\tComputing the number of submissions of the form with id '%s'" % form_id, 'info')
@@ -326,29 +587,42 @@ class OdkForms():
     def get_form_structure_as_json(self, form_id):
         """
         check whether the form structure is already saved in the DB
+
+        The saved structure is keyed on the form version. It is processed again when the forms list has a newer version of the
+        form, and the processed structures are cached in memory by (form_id, form_version)
         """
         if form_id == -1:
             terminal.tprint("\tNot processing this form with an ID of -1", 'fail')
             return None
 
         try:
-            cur_form = ODKForm.objects.get(form_id=form_id)
-
-            # check if the structure exists
-            if cur_form.structure is None:
+            # get the versions first, the structures are only loaded when they are not cached
+            cur_form = ODKForm.objects.only('id', 'form_id', 'form_name', 'form_version', 'latest_version').get(form_id=form_id)
+            is_outdated = cur_form.latest_version is not None and cur_form.latest_version != cur_form.form_version
+
+            processed_nodes = None
+            if not is_outdated:
+                (is_found, processed_nodes) = form_structures_cache.lookup((form_id, cur_form.form_version))
+                if is_found:
+                    return processed_nodes
+                processed_nodes = ODKForm.objects.filter(id=cur_form.id, structure__isnull=False).values_list('processed_structure', flat=True).first()
+
+            # check if the structure exists and is of the current version
+            if processed_nodes is None:
                 # we don't have the structure, so fetch, process and save the structure
-                terminal.tprint("\tThe form '%s' doesn't have a saved structure, so lets fetch it and add it" % cur_form.form_name, 'warn')
+                if is_outdated:
+                    terminal.tprint("\tThe form '%s' has a new version, so lets fetch it and process it again" % cur_form.form_name, 'warn')
+                else:
+                    terminal.tprint("\tThe form '%s' doesn't have a saved structure, so lets fetch it and add it" % cur_form.form_name, 'warn')
                 (processed_nodes, structure) = self.get_form_structure_from_server(form_id)
                 if structure is not None:
-                    cur_form.structure = structure
-                    cur_form.processed_structure = processed_nodes
-                    cur_form.publish()
+                    self.save_form_structure(cur_form, processed_nodes, structure)
                 else:
                     raise Exception("There was an error in fetching the selected form and it is not yet saved in the database.")
             else:
                 terminal.tprint("\tFetching the form's '%s' structure from the database" % cur_form.form_name, 'okblue')
-                processed_nodes = cur_form.processed_structure
-                # terminal.tprint(json.dumps(cur_form.structure), 'ok')
+
+            form_structures_cache.set((form_id, cur_form.form_version), processed_nodes)
         except IntegrityError as e:
             # We can live with this
             terminal.tprint(str(e), 'fail')
@@ -368,32 +642,61 @@ class OdkForms():
         """
         url = "%s/%s%d/form.json" % (self.server, self.form_rep, form_id)
         terminal.tprint("Fetching the form structure for form with id = %d" % form_id, 'header')
-        form_structure = self.process_curl_request(url)
+        saved_form = ODKForm.objects.filter(form_id=form_id, structure__isnull=False).values('structure', 'processed_structure').first()
+        (is_modified, r) = self.process_conditional_request(url, saved_form is not None)
 
-        if form_structure is None:
+        if r is None:
             return (None, None)
 
+        if is_modified:
+            form_structure = r.json()
+            all_nodes = self.process_form_structure(form_structure, form_id)
+        else:
+            terminal.tprint("\tThe form structure hasn't changed, using the saved structure", 'ok')
+            form_structure = saved_form['structure']
+            all_nodes = saved_form['processed_structure']
+
+        # get the form metadata if there is additional metadata
+        md_url = "%s/%s?xform=%d" % (self.server, self.metadata_uri, form_id)
+        terminal.tprint("Fetching the form metadata for form with id = %d" % form_id, 'header')
+        (md_is_modified, md_r) = self.process_conditional_request(md_url)
+        if md_r is not None and md_is_modified:
+            form_metadata = md_r.json()
+            # terminal.tprint(json.dumps(form_metadata), 'warn')
+            # we need to process the metadata, especially the csv files which have been added
+            if len(form_metadata) == 0 or self.process_form_metadata(form_metadata, form_id):
+                self.save_request_validators(md_url, md_r)
+        elif md_r is not None:
+            terminal.tprint("\tThe form metadata hasn't changed, skipping it", 'ok')
+
+        if is_modified:
+            self.save_request_validators(url, r)
+
+        return all_nodes, form_structure
+
+    def process_form_structure(self, form_structure, form_id):
+        """
+        Extract the nodes of a form structure and save the dictionary items of the form
+        """
         self.cur_node_id = 0
         self.cur_form_id = form_id
         self.repeat_level = 0
         self.all_nodes = []
+        self.pending_dictionary_items = {}
         self.top_node = {"name": "Main", "label": "Top Level", "parent_id": -1, "type": "top_level", "id": 0}
 
         self.top_level_hierarchy = self.extract_repeating_groups(form_structure, 0)
         self.all_nodes.insert(0, self.top_node)
+        self.save_dictionary_items()
         # terminal.tprint("Processed %d group nodes" % self.cur_node_id, 'warn')
-        
-        # get the form metadata if there is additional metadata
-        url = "%s/%s?xform=%d" % (self.server, self.metadata_uri, form_id)
-        terminal.tprint("Fetching the form metadata for form with id = %d" % form_id, 'header')
-        form_metadata = self.process_curl_request(url)
-        # terminal.tprint(json.dumps(form_metadata), 'warn')
-        if len(form_metadata) != 0:
-            # we need to process the metadata, especially the csv files which have been added
-            self.process_form_metadata(form_metadata, form_id)
-        # sys.exit()
-        
-        return self.all_nodes, form_structure
+        return self.all_nodes
+
+    def save_form_structure(self, cur_form, processed_nodes, structure):
+        # save the fetched structure of a form, it is of the latest version listed for the form
+        cur_form.structure = structure
+        cur_form.processed_structure = processed_nodes
+        cur_form.form_version = cur_form.latest_version if cur_form.latest_version is not None else structure.get('version')
+        cur_form.publish()
 
     def extract_repeating_groups(self, nodes, parent_id):
         """
@@ -461,75 +764,117 @@ class OdkForms():
 
     def process_form_metadata(self, metadata, form_id):
         # loop through all the metadata and for each csv file, download it and then process it
+        # returns True if all the csv files were processed successfully
         try:
             for form_md in metadata:
                 if form_md['data_file_type'] == 'text/csv':
                     # download this guy
                     url = "%s/%s/%d.csv" % (self.server, self.metadata_uri, form_md['id'])
                     terminal.tprint("Fetching the csv file '%s'" % form_md['data_value'], 'header')
-                    file_path = '%d_%s' % (form_md['id'], form_md['data_value'])
-                    self.fetch_form_metadata(url, {'path_to_save': file_path})
-                    
-                    # now lets process the downloaded file
-                    self.process_downloaded_file(file_path, form_id)
+                    r = self.fetch_form_metadata(url)
+                    if r is None:
+                        terminal.tprint("\tThe csv file '%s' hasn't changed, skipping it" % form_md['data_value'], 'ok')
+                        continue
 
-                    # if no error, the file is processed, now we delete it
-                    os.remove(file_path)
+                    # now lets import the file as it is downloaded
+                    content_hash = self.process_downloaded_file(r, form_id)
+                    self.save_request_validators(url, r, content_hash)
         except Exception:
             sentry.captureException()
+            return False
+
+        return True
 
     def add_dictionary_items(self, node, node_type):
-        # check if this key already exists
-        dict_item = DictionaryItems.objects.filter(form_id=self.cur_form_id, t_key=node['name'])
+        # queue the node and its choices, they are saved in bulk by save_dictionary_items
+        # the first definition of a key in a form is the one which is saved
+        item_key = (self.cur_form_id, node['name'])
+        if item_key not in self.pending_dictionary_items:
+            node_label = node['label'] if 'label' in node else node['name']
+            self.pending_dictionary_items[item_key] = DictionaryItems(
+                form_id=self.cur_form_id,
+                t_key=node['name'],
+                t_type=node_type,
+                t_value=node_label
+            )
 
-        if dict_item.count() == 0:
-            try:
-                # terminal.tprint(json.dumps(node), 'warn')
-                node_label = node['label'] if 'label' in node else node['name']
-                dict_item = DictionaryItems(
-                    form_id=self.cur_form_id,
-                    t_key=node['name'],
-                    t_type=node_type,
-                    t_value=node_label
-                )
-                dict_item.publish()
-
-                if 'type' in node:
-                    if node['type'] == 'select one' or node['type'] == 'select all that apply':
-                        if 'children' in node:
-                            for child in node['children']:
-                                self.add_dictionary_items(child, 'choice')
-            except IntegrityError as e:
-                # We can live with this
-                terminal.tprint(str(e), 'okblue')
-            except Exception as e:
-                print((traceback.format_exc()))
-                logger.debug(str(e))
-                terminal.tprint(str(e), 'fail')
-                raise Exception(str(e))
+        if 'type' in node:
+            if node['type'] == 'select one' or node['type'] == 'select all that apply':
+                if 'children' in node:
+                    for child in node['children']:
+                        self.add_dictionary_items(child, 'choice')
 
-    def process_downloaded_file(self, input_file, form_id):
-        with open(input_file, 'rt') as in_file:
-            ptions_data = csv.DictReader(in_file, delimiter=',', quotechar='"')
-            for row in ptions_data:
-                try:
-                    dict_item = DictionaryItems.objects.filter(form_id=form_id).filter(t_key=row['name'])
-                    if dict_item.count() == 1:
-                        # this options is already saved...
-                        continue
-                    dict_item = DictionaryItems(
-                        form_id=form_id,
-                        t_key=row['name'],
-                        t_type='choice',
-                        t_value=row['label']
-                    )
-                    dict_item.publish()
-                except IntegrityError as e:
-                    # We can live with this
-                    terminal.tprint(str(e), 'okblue')
-                except Exception as e:
-                    terminal.tprint(str(e), 'fail')
-                    raise
+    def save_dictionary_items(self):
+        """
+        Save the queued dictionary items in one go, skipping the items which are already saved
+        """
+        if len(self.pending_dictionary_items) == 0:
+            return
+
+        try:
+            terminal.tprint("\tSaving %d dictionary items" % len(self.pending_dictionary_items), 'okblue')
+            DictionaryItems.objects.bulk_create(list(self.pending_dictionary_items.values()), batch_size=1000, ignore_conflicts=True)
+        except Exception as e:
+            print((traceback.format_exc()))
+            logger.debug(str(e))
+            terminal.tprint(str(e), 'fail')
+            raise Exception(str(e))
+        finally:
+            self.pending_dictionary_items = {}
+            # the dictionary has new items
+            dictionary_cache.invalidate()
+
+    def process_downloaded_file(self, r, form_id):
+        """
+        Import the options of a streamed itemset csv file into the dictionary
+
+        The name and label columns are copied into a temporary table as the file is received, and then merged into
+        dictionary_items in one statement, skipping the options which are already saved. Returns the sha1 hash of the file
+        """
+        content_hash = hashlib.sha1()
+        options_data = csv.reader(iter_text_lines(iter_response_text(r, content_hash=content_hash)), delimiter=',', quotechar='"')
+        header = next(options_data, None)
+        if header is None:
+            return content_hash.hexdigest()
+
+        name_index = header.index('name')
+        # the label might be localised, eg label::English
+        label_columns = [i for i, column in enumerate(header) if column == 'label' or column.startswith('label::')]
+        label_index = label_columns[0] if len(label_columns) != 0 else name_index
+
+        def options_csv():
+            # re-encode the rows with just the name and label for COPY
+            out_line = io.StringIO()
+            writer = csv.writer(out_line)
+            for row in options_data:
+                if len(row) <= max(name_index, label_index):
+                    continue
+                writer.writerow([row[name_index], row[label_index]])
+                yield out_line.getvalue()
+                out_line.seek(0)
+                out_line.truncate()
+
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("CREATE TEMP TABLE itemset_import (row_no serial, t_key text, t_value text) ON COMMIT DROP")
+                    cursor.copy_expert("COPY itemset_import (t_key, t_value) FROM STDIN WITH (FORMAT csv)", IteratorFile(options_csv()))
+                    # when an option is listed more than once, the first one is saved
+                    cursor.execute("""
+                        INSERT INTO dictionary_items (date_created, date_modified, form_id, t_key, t_locale, t_type, t_value)
+                        SELECT DISTINCT ON (left(t_key, 100)) now(), now(), %s, left(t_key, 100), '', 'choice', coalesce(left(t_value, 1000), '')
+                        FROM itemset_import WHERE t_key != '' ORDER BY left(t_key, 100), row_no
+                        ON CONFLICT (form_id, t_key) DO NOTHING
+                    """, [form_id])
+                    terminal.tprint("\tAdded %d new options to the dictionary" % cursor.rowcount, 'ok')
+        except Exception as e:
+            terminal.tprint(str(e), 'fail')
+            raise
+        finally:
+            # the dictionary has new items
+            dictionary_cache.invalidate()
+
+        return content_hash.hexdigest()
 
     def add_to_all_nodes(self, t_node):
         # add a node to the list of all nodes for creating the tree
@@ -543,134 +888,152 @@ class OdkForms():
 
         self.all_nodes.append(t_node)
 
-    def delete_folder_contents(self, folder_path):
-        """
-        Given a path to a folder, delete its contents
-        """
-        for filename in os.listdir(folder_path):
-            if filename == '.' or filename == '..':
-                    continue
-            terminal.tprint("Deleting '%s'" % folder_path + os.sep + filename, 'fail')
-            os.unlink(folder_path + os.sep + filename)
-
-    def save_user_view(self, form_id, view_name, nodes, all_submissions, structure):
+    def save_user_view(self, form_id, view_name, nodes, all_submissions, structure, associated_forms=None):
         """
         Given a view with a section of the user defined data, create a view of the selected nodes
+
+        Each sheet of the submissions is saved to a table typed after the declared types of the questions in the associated forms,
+        and its rows are loaded with COPY FROM STDIN. The tables, their keys and the view records are all created in one transaction
         """
         # get a proper view name
         prop_view_name = self.formulate_view_name(view_name)
+        if FormViews.objects.filter(view_name=view_name).exists():
+            logger.error("Duplicate view name '%s'. Can't save." % view_name)
+            raise Exception("Duplicate view name '%s'. Can't save." % view_name)
 
-        # save the submissions as an excel an then call a function to create the table(s)
-        # create a temp dir for this
-        if os.path.exists(prop_view_name):
-            self.delete_folder_contents(prop_view_name)
-        else:
-            # create the directory
-            terminal.tprint("Create the directory '%s'" % prop_view_name, 'warn')
-            os.makedirs(prop_view_name)
-
-        writer = ExcelWriter(prop_view_name, 'csv', prop_view_name)
-        writer.create_workbook(all_submissions, structure)
-        terminal.tprint("\tFinished creating the csv files", 'warn')
+        # split the submissions into the rows of each sheet, the same way as the exports
+        sheet_rows = dict((sheet_name, []) for sheet_name in structure)
+        for submission in all_submissions:
+            for sheet_name, row in self.iter_sheet_rows(submission, 'main'):
+                sheet_rows.setdefault(sheet_name, []).append(row)
 
-        # now we have all our selected submissions as csv files, so process them
-        import_command = "csvsql --db 'postgresql:///%s?user=%s&password=%s' --encoding utf-8 --blanks --insert --tables %s %s"
+        declared_types = self.declared_column_types(associated_forms if associated_forms is not None else [form_id])
+        odk_form = ODKForm.objects.get(form_id=form_id)
         table_views = []
-        for filename in os.listdir(prop_view_name):
-            if filename == '.' or filename == '..':
-                continue
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for sheet_name, rows in sheet_rows.items():
+                        table_name = "%s_%s" % (prop_view_name, sheet_name)
+                        table_name_hash_dig = "v_%s" % hashlib.md5(table_name.encode('utf-8')).hexdigest()
+                        terminal.tprint("Hashed the table name '%s' to '%s'" % (table_name, table_name_hash_dig), 'warn')
+
+                        columns = self.view_table_columns(sheet_name, structure.get(sheet_name, ['unique_id']), rows, declared_types)
+                        terminal.tprint("\tCreating the table '%s' with %d rows" % (table_name_hash_dig, len(rows)), 'okblue')
+                        cursor.execute("create table %s (%s)" % (table_name_hash_dig, ', '.join("%s %s" % (column_name, sql_type) for field, column_name, sql_type in columns)))
+                        cursor.copy_expert("copy %s from stdin" % table_name_hash_dig, IteratorFile(self.iter_view_copy_lines(rows, columns)))
+
+                        logging.debug("Adding a primary key constraint for the table '%s'" % table_name)
+                        cursor.execute("alter table %s add primary key (%s)" % (table_name_hash_dig, 'unique_id'))
+                        if sheet_name != 'main':
+                            # for the other tables, add an index to top_id and parent_id
+                            logging.debug("Adding indexes to '%s' and '%s' for the table '%s'" % ('top_id', 'parent_id', table_name))
+                            cursor.execute("create index %s_%s on %s (%s)" % (table_name_hash_dig, 'top_id', table_name_hash_dig, 'top_id'))
+                            cursor.execute("create index %s_%s on %s (%s)" % (table_name_hash_dig, 'parent_id', table_name_hash_dig, 'parent_id'))
+
+                        table_views.append({'table_name': table_name, 'hashed_name': table_name_hash_dig})
 
-            basename = os.path.splitext(filename)[0]
-            table_name = "%s_%s" % (prop_view_name, basename)
-            table_name_hash = hashlib.md5(table_name)
-            # terminal.tprint("Hashed the table name '%s'" % table_name, 'warn')
-            table_name_hash_dig = "v_%s" % table_name_hash.hexdigest()
-            print (table_name_hash_dig)
-            terminal.tprint("Hashed the table name '%s' to '%s'" % (table_name, table_name_hash_dig), 'warn')
-
-            filename = prop_view_name + os.sep + filename
-
-            terminal.tprint("\tProcessing the file '%s' for saving to the database" % filename, 'okblue')
-            if filename.endswith(".csv"):
-                cmd = import_command % (
-                    settings.DATABASES['default']['NAME'],
-                    settings.DATABASES['default']['USER'],
-                    settings.DATABASES['default']['PASSWORD'],
-                    table_name_hash_dig,
-                    filename,
+                # save the new view
+                form_view = FormViews(
+                    form=odk_form,
+                    view_name=view_name,
+                    proper_view_name=prop_view_name,
+                    structure=nodes
                 )
-                terminal.tprint("\tRunning the command '%s'" % cmd, 'ok')
-                print((subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()))
+                form_view.publish()
+
+                # save these submissions to the database
+                ViewsData.objects.bulk_create([ViewsData(view=form_view, raw_data=submission) for submission in all_submissions], batch_size=1000)
 
-                # run commands to create primary key
+                # add the tables to the lookup table of views
+                for view in table_views:
+                    cur_view = ViewTablesLookup(
+                        view=form_view,
+                        table_name=view['table_name'],
+                        hashed_name=view['hashed_name']
+                    )
+                    cur_view.publish()
+        except Exception as e:
+            logging.error("For some reason I can't create the tables of the view '%s', so nothing was saved" % view_name)
+            logging.error(str(e))
+            raise Exception("For some reason I can't create the tables of the view '%s': %s" % (view_name, str(e)))
+
+    def declared_column_types(self, form_ids):
+        """
+        Get the SQL types of the declared questions in each sheet of the forms, keyed by (sheet_name, clean_key)
+
+        The types come from the flatten plans of the forms, and the questions declared with different types in different forms are text
+        """
+        declared_types = {}
+        for form_id in form_ids:
+            for clean_key, sheet_name, q_type in self.get_flatten_plan(int(form_id)).values():
+                sql_type = view_column_types.get(q_type, 'text')
+                declared_types[(sheet_name, clean_key)] = sql_type if declared_types.get((sheet_name, clean_key), sql_type) == sql_type else 'text'
+
+        return declared_types
+
+    def view_table_columns(self, sheet_name, fields, rows, declared_types):
+        """
+        Get the columns of a view table as a list of (field, quoted column name, SQL type), given the declared SQL types of the columns
+
+        The columns of the integer, decimal, date and dateTime questions get the matching SQL type, unless one of their values can't
+        be parsed as such, in which case the column is demoted to text like the other columns
+        """
+        columns = []
+        column_names = set()
+        for field in order_fields(list(fields)):
+            sql_type = declared_types.get((sheet_name, field), 'text')
+            if sql_type != 'text':
                 try:
-                    with connection.cursor() as cursor:
-                        logging.debug("Adding a primary ket constraint for the table '%s'" % table_name)
-                        query = "alter table %s add primary key (%s)" % (table_name_hash_dig, 'unique_id')
-                        cursor.execute(query)
-
-                        # if table name has a main on it, it must have a _uuid field which should be unique
-                        if re.search("main$", table_name) is not None:
-                            # this is finicky, omit it for now
-                            terminal.tprint("Not adding a unique constraint for column '_uuid'", 'fail')
-                            # logging.debug("Adding unique constraint '%s' for the table '%s'" % ('_uuid', table_name))
-                            # uquery = "alter table %s add constraint %s_%s unique (%s)" % (table_name_hash_dig, table_name_hash_dig, 'uuid', '_uuid')
-                            # cursor.execute(uquery)
-                        else:
-                            # for the other tables, add an index to top_id
-                            logging.debug("Adding indexes to '%s' and '%s' for the table '%s'" % ('top_id', 'parent_id', table_name))
-                            uquery = "create index %s_%s on %s (%s)" % (table_name_hash_dig, 'top_id', table_name_hash_dig, 'top_id')
-                            cursor.execute(uquery)
-                            uquery = "create index %s_%s on %s (%s)" % (table_name_hash_dig, 'parent_id', table_name_hash_dig, 'parent_id')
-                            cursor.execute(uquery)
-                except Exception as e:
-                    logging.error("For some reason can't create a primary key or unique key, raise an error and delete the view")
-                    logging.error(str(e))
-                    with connection.cursor() as cursor:
-                        dquery = "drop table %s" % table_name_hash_dig
-                        cursor.execute(dquery)
-                    raise Exception("For some reason I can't create a primary key or unique key for the table %s. Deleting it entirely" % table_name)
+                    for row in rows:
+                        self.view_copy_value(row.get(field), sql_type)
+                except ValueError:
+                    terminal.tprint("\tThe column '%s' has values which are not %s, saving it as text" % (field, sql_type), 'warn')
+                    sql_type = 'text'
 
-                table_views.append({'table_name': table_name, 'hashed_name': table_name_hash_dig})
+            # postgres truncates the names to 63 bytes, so keep the truncated names unique
+            column_name = field.encode('utf-8')[:63].decode('utf-8', 'ignore')
+            suffix = 1
+            while column_name in column_names:
+                suffix += 1
+                column_name = field.encode('utf-8')[:63 - len(str(suffix)) - 1].decode('utf-8', 'ignore') + '_%d' % suffix
+            column_names.add(column_name)
 
-        # clean up process
-        # delete the generated files
-        self.delete_folder_contents(prop_view_name)
-        os.rmdir(prop_view_name)
+            columns.append((field, '"%s"' % column_name.replace('"', '""'), sql_type))
 
-        form_view = FormViews.objects.filter(view_name=view_name)
-        odk_form = ODKForm.objects.get(form_id=form_id)
+        return columns
 
-        if form_view.count() == 0:
-            # save the new view
-            form_view = FormViews(
-                form=odk_form,
-                view_name=view_name,
-                proper_view_name=prop_view_name,
-                structure=nodes
-            )
-            form_view.publish()
+    def view_copy_value(self, value, sql_type):
+        """
+        Get the text of a value for a column of the SQL type, or None for a null. Raises a ValueError when the value doesn't match the type
 
-            # save these submissions to the database
-            for submission in all_submissions:
-                new_submission = ViewsData(
-                    view=form_view,
-                    raw_data=submission
-                )
-                new_submission.publish()
-        else:
-            logger.error("Duplicate view name '%s'. Can't save." % view_name)
-            # raise Exception("Duplicate view name '%s'. Can't save." % view_name)
-            # return
-
-        # add the tables to the lookup table of views
-        for view in table_views:
-            cur_view = ViewTablesLookup(
-                view=form_view,
-                table_name=view['table_name'],
-                hashed_name=view['hashed_name']
-            )
-            cur_view.publish()
+        The missing values, saved as N/A, are nulls in the typed columns
+        """
+        if sql_type == 'text':
+            if value is None:
+                return None
+            return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+        value = parse_column_value(value, sql_type)
+        if value is None:
+            return None
+        elif sql_type == 'bigint':
+            return str(value)
+        elif sql_type == 'double precision':
+            return repr(value)
+        return value.isoformat()
+
+    def iter_view_copy_lines(self, rows, columns):
+        # the rows in the text format of COPY, with the missing values as nulls
+        for row in rows:
+            values = []
+            for field, column_name, sql_type in columns:
+                value = self.view_copy_value(row.get(field), sql_type)
+                if value is None:
+                    values.append('\\N')
+                else:
+                    values.append(value.replace('\x00', '').replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+            yield '\t'.join(values) + '\n'
 
     def formulate_view_name(self, view_name):
         """
@@ -696,52 +1059,50 @@ class OdkForms():
     def fetch_merge_data(self, form_id, nodes, d_format, download_type, view_name):
         """
         Given a form id and nodes of interest, get data from all associated forms
+
+        The 'submissions' download type returns a lazy iterator over the processed submissions of the associated forms
         """
 
-        # get the form metadata
-        settings = ConfigParser()
-        settings.read(self.forms_settings)
+        # get all the form ids belonging to the same group
+        form_group = form_registry.get_form_group(form_id)
+        group_forms = None
+        if form_group is not None:
+            self.form_group = form_group
+            group_forms = form_registry.get_group_forms(form_group)
 
-        associated_forms = []
-        try:
-            # get all the form ids belonging to the same group
-            self.form_group = settings.get('id_' + str(form_id), 'form_group')
-            for section in settings.sections():
-                this_group = settings.get(section, 'form_group')
-                if this_group == self.form_group:
-                    m = re.findall("/?id_(\d+)$", section)
-                    associated_forms.append(m[0])
-                else:
-                    # form_group section doesn't exist, so skip this
-                    logger.info("Not interested in this form (%s), so skip it" % this_group)
-                    continue
-            form_name = settings.get(self.form_group, 'name')
-        except Exception as e:
+        if group_forms is not None:
+            (associated_forms, form_name) = group_forms
+        else:
             # terminal.tprint("We didn't find the form with id %s. This functionality will be deprecated... Falling to default methods" % str(form_id), 'fail')
-            # print(traceback.format_exc())
             # there is an error getting the associated forms, so get data from just one form
-            # terminal.tprint(str(e), 'fail')
-            associated_forms.append(form_id)
+            associated_forms = [form_id]
             form_name = "Form%s" % str(form_id)
 
-        # having all the associated form ids, fetch the required data
-        all_submissions = []
-
         # since we shall be merging similar forms as one, declare the indexes here
         self.cur_node_id = 0
         self.indexes = {}
         self.sections_of_interest = {}
         self.output_structure = {'main': ['unique_id']}
+        # the columns of each sheet in output_structure, as sets for quick lookups
+        self.output_columns = {}
         self.indexes['main'] = 1
 
-        for form_id in associated_forms:
-            this_submissions = self.get_form_submissions_as_json(int(form_id), nodes)
+        if download_type == 'submissions':
+            # the processed submissions of all the associated forms, which are only processed as they are read
+            return itertools.chain.from_iterable(self.iter_form_submissions(int(form_id), nodes) for form_id in associated_forms)
 
-            if this_submissions is None:
-                continue
-            else:
-                if(isinstance(this_submissions, list)):
-                    all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+        if download_type != 'download_save' and d_format in SheetArchiveWriter.file_extensions:
+            # the archives are written from the DataFrames of the columnar flattener
+            all_tables = itertools.chain.from_iterable(self.iter_form_tables(int(form_id), nodes) for form_id in associated_forms)
+            return self.stream_export(None, d_format, form_name, associated_forms, all_tables)
+
+        if download_type != 'download_save':
+            # the export only needs the rows of each sheet, so spool them and stream the export as it is written
+            all_rows = itertools.chain.from_iterable(self.iter_form_rows(int(form_id), nodes) for form_id in associated_forms)
+            return self.stream_export(all_rows, d_format, form_name, associated_forms)
+
+        # having all the associated form ids, fetch the required data
+        all_submissions = list(itertools.chain.from_iterable(self.iter_form_submissions(int(form_id), nodes) for form_id in associated_forms))
 
         if len(all_submissions) == 0:
             terminal.tprint("The form (%s) has no submissions for download" % str(form_name), 'fail')
@@ -751,75 +1112,308 @@ class OdkForms():
         # check if there is need to create a database view of this data
         if download_type == 'download_save':
             try:
-                self.save_user_view(form_id, view_name, nodes, all_submissions, self.output_structure)
+                # the view is linked to the last form in the group
+                self.save_user_view(associated_forms[-1], view_name, nodes, all_submissions, self.output_structure, associated_forms)
             except Exception as e:
                 return {'is_downloadable': False, 'error': True, 'message': str(e)}
-        elif download_type == 'submissions':
-            return all_submissions
 
-        # now we have all the submissions, create the Excel sheet
+        # now we have all the submissions, stream them in the requested format
+        all_rows = itertools.chain.from_iterable(self.iter_sheet_rows(submission, 'main') for submission in all_submissions)
+        return self.stream_export(all_rows, d_format, form_name, associated_forms)
+
+    def stream_export(self, all_rows, d_format, form_name, form_ids, all_tables=None):
+        """
+        Spool the (sheet_name, row) tuples of an export and return the generator of the export file in the requested format
+
+        The xlsx format is a workbook with a sheet per sheet of the output structure, while the csv.zip, parquet and arrow formats
+        are zip archives with a file per sheet. The archives can be spooled from the (sheet_name, DataFrame) tuples of the columnar
+        flattener, given as all_tables instead of the rows, and their Parquet and Arrow columns are typed after the declared types
+        of the questions in the forms
+        """
         now = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_name = form_name + '_' + now
         if d_format == 'xlsx':
-            # now lets save the data to an excel file
-            output_name = './' + form_name + '_' + now + '.xlsx'
-            self.save_submissions_as_excel(all_submissions, self.output_structure, output_name)
-            return {'is_downloadable': True, 'filename': output_name}
+            writer = StreamingExcelWriter()
+        elif d_format in SheetArchiveWriter.file_extensions:
+            writer = SheetArchiveWriter(d_format, self.declared_column_types(form_ids))
+        else:
+            return {'is_downloadable': False, 'error': True, 'message': "Unsupported export format '%s'" % str(d_format)}
 
-    def save_submissions_as_excel(self, submissions, structure, filename):
-        writer = ExcelWriter(filename)
-        writer.create_workbook(submissions, structure)
+        main_rows = writer.spool_tables(all_tables) if all_tables is not None else writer.spool_rows(all_rows)
+        if main_rows == 0:
+            writer.close()
+            terminal.tprint("The form (%s) has no submissions for download" % str(form_name), 'fail')
+            return {'is_downloadable': False, 'error': False, 'message': "The form (%s) has no submissions for download" % str(form_name)}
 
-    def get_form_submissions_as_json(self, form_id, screen_nodes):
-        # given a form id get the form submissions
-        # if the screen_nodes is given, process and return only the subset of data in those forms
+        if d_format == 'xlsx':
+            return {'is_downloadable': True, 'filename': output_name + '.xlsx', 'content_type': writer.content_type, 'content': writer.iter_workbook(self.output_structure)}
+
+        return {'is_downloadable': True, 'filename': writer.archive_name(output_name), 'content_type': writer.content_type, 'content': writer.iter_archive(self.output_structure)}
+
+    def iter_form_submissions(self, form_id, screen_nodes):
+        """
+        Iterate over the processed submissions of a form
 
+        The saved submissions are read with a server side cursor and processed one at a time, so the form is never held in memory.
+        Forms with more than FLATTEN_CHUNK_SIZE submissions are processed in chunks by FLATTEN_PROCESSES processes when it is more than 1
+        """
         submissions_list = self.get_all_submissions(form_id)
 
         if submissions_list is None or submissions_list.count() == 0:
             terminal.tprint("The form with id '%s' has no submissions returning as such" % str(form_id), 'fail')
-            return None
+            return
 
-        # get the form metadata
-        settings = ConfigParser()
-        settings.read(self.forms_settings)
+        nodes_of_interest = self.prepare_form_flattening(form_id, screen_nodes)
+        processes = getattr(settings, 'FLATTEN_PROCESSES', 1)
+        chunk_size = getattr(settings, 'FLATTEN_CHUNK_SIZE', 5000)
+        if processes > 1 and submissions_list.count() > chunk_size and 'fork' in multiprocessing.get_all_start_methods() and not connection.in_atomic_block:
+            yield from self.iter_flattened_chunks(submissions_list, nodes_of_interest, processes, chunk_size)
+            return
 
-        try:
-            # get the fields to include as part of the form metadata
-            form_meta = settings.get('id_' + str(form_id), 'metadata').split(',')
-            self.pk_name = settings.get('id_' + str(form_id), 'pk_name')
-            self.sk_format = settings.get('id_' + str(form_id), 'sk_name')
-        except Exception:
-            # terminal.tprint("Form settings haven't been defined - %s" % str(e), 'fail')
+        for data in submissions_list.iterator(chunk_size=self.submissions_batch_size):
+            # data, csv_files = self.post_data_processing(data)
+            pk_key = self.pk_name + str(self.indexes['main'])
+            data = data['raw_data']
+            data['unique_id'] = pk_key
+            data = self.process_node(data, 'main', nodes_of_interest, False)
+            self.indexes['main'] += 1
+
+            yield data
+
+    def iter_form_tables(self, form_id, screen_nodes):
+        """
+        Iterate over the submissions of a form as (sheet_name, DataFrame) tuples, flattened in batches by the columnar flattener
+
+        The DataFrames have the same rows as the sheets of iter_form_rows, and the sheet columns are added to self.output_structure
+        as the batches are flattened. The batches have FLATTEN_CHUNK_SIZE submissions
+        """
+        submissions_list = self.get_all_submissions(form_id)
+
+        if submissions_list is None or submissions_list.count() == 0:
+            terminal.tprint("The form with id '%s' has no submissions returning as such" % str(form_id), 'fail')
+            return
+
+        nodes_of_interest = self.prepare_form_flattening(form_id, screen_nodes)
+        converters = {country_qst: self.get_clean_country_code for country_qst in self.country_qsts}
+        batch_size = getattr(settings, 'FLATTEN_CHUNK_SIZE', 5000)
+        raw_submissions = (data['raw_data'] for data in submissions_list.iterator(chunk_size=self.submissions_batch_size))
+        for submissions_batch in self.iter_batches(raw_submissions, batch_size):
+            tables = flatten_submissions(submissions_batch, self.flatten_key, self.pk_name, self.indexes, nodes_of_interest, converters, self.output_structure)
+            yield from tables.items()
+
+    def flatten_key(self, key):
+        # the clean name of a raw key, from the flatten plan of the current form
+        planned_key = self.flatten_plan.get(key)
+        return planned_key[0] if planned_key is not None else clean_json_key(key)
+
+    def prepare_form_flattening(self, form_id, screen_nodes):
+        # set the primary key and the flatten plan of the form, and get the nodes of interest
+        # get the fields to include as part of the form metadata
+        form_settings = form_registry.get_form_settings(form_id)
+        if form_settings is not None:
+            (form_meta, self.pk_name, self.sk_format) = form_settings
+        else:
             # logger.info("The settings for the form id (%s) haven't been defined" % str(form_id))
-            # logger.debug(e)
             form_meta = []
             self.pk_name = 'hh_id'
 
+        nodes_of_interest = None
         if screen_nodes is not None:
             screen_nodes.extend(form_meta)
             screen_nodes.append('unique_id')
+            nodes_of_interest = set(screen_nodes)
         # terminal.tprint(json.dumps(screen_nodes), 'warn')
 
-        submissions = []
-        for data in submissions_list:
-            # data, csv_files = self.post_data_processing(data)
-            pk_key = self.pk_name + str(self.indexes['main'])
-            data = data['raw_data']
-            data['unique_id'] = pk_key
-            data = self.process_node(data, 'main', screen_nodes, False)
+        self.flatten_plan = self.get_flatten_plan(form_id)
+        return nodes_of_interest
 
-            submissions.append(data)
-            self.indexes['main'] += 1
+    def iter_flattened_chunks(self, submissions_list, nodes_of_interest, processes, chunk_size):
+        """
+        Process the submissions in chunks with a pool of forked processes, with the same output as processing them one at a time
 
-        return submissions
+        The chunks are read lazily, and the rows that each chunk adds to each sheet are counted as it is read, so that it is given
+        its own range of unique ids per sheet. At most two chunks per process are in flight, and the processed chunks are yielded
+        and their sheet columns merged in the order of the chunks
+        """
+        global flatten_job
+        terminal.tprint("\tProcessing the submissions in chunks of %d with %d processes" % (chunk_size, processes), 'info')
+
+        # the forked processes inherit the job. They shouldn't share the database connection, so it is closed before the fork
+        flatten_job = {'odk_forms': self, 'nodes_of_interest': nodes_of_interest}
+        connection.close()
+        try:
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                pending = deque()
+                next_indexes = {}
+                raw_submissions = (data['raw_data'] for data in submissions_list.iterator(chunk_size=self.submissions_batch_size))
+                for chunk in self.iter_batches(raw_submissions, chunk_size):
+                    # reserve the ids of the chunk, continuing from the current indexes like process_list
+                    counts = {'main': len(chunk)}
+                    for data in chunk:
+                        self.count_sheet_rows(data, nodes_of_interest, counts)
+
+                    chunk_indexes = {}
+                    for sheet_name, count in counts.items():
+                        if sheet_name not in next_indexes:
+                            next_indexes[sheet_name] = self.indexes[sheet_name] if sheet_name in self.output_structure else 1
+                        chunk_indexes[sheet_name] = next_indexes[sheet_name]
+                        next_indexes[sheet_name] += count
+
+                    pending.append(pool.apply_async(flatten_chunk, ((chunk, chunk_indexes),)))
+                    while len(pending) >= 2 * processes:
+                        yield from self.merge_flattened_chunk(pending.popleft().get())
+
+                while len(pending) != 0:
+                    yield from self.merge_flattened_chunk(pending.popleft().get())
+
+            self.indexes.update(next_indexes)
+        finally:
+            flatten_job = {}
+
+    def merge_flattened_chunk(self, result):
+        (processed_chunk, chunk_structure) = result
+        self.merge_output_structure(chunk_structure)
+        return processed_chunk
+
+    def count_sheet_rows(self, node, nodes_of_interest, counts):
+        """
+        Count the rows that process_node adds to each sheet when processing the node, ie the ids it takes from self.indexes
+
+        The sheets are added to counts in the order in which process_node creates them
+        """
+        for key, value in node.items():
+            clean_key = self.flatten_key(key)
+            if clean_key == '_geolocation':
+                continue
+            if nodes_of_interest is not None and clean_key not in nodes_of_interest:
+                continue
+
+            if type(value) is list:
+                counts[clean_key] = counts.get(clean_key, 0) + len(value)
+                for item in value:
+                    if type(item) is dict:
+                        # process_list doesn't pass the nodes of interest
+                        self.count_sheet_rows(item, None, counts)
+            elif type(value) is dict:
+                self.count_sheet_rows(value, nodes_of_interest, counts)
+
+    def merge_output_structure(self, structure):
+        # add the sheets and columns of a processed chunk to self.output_structure, keeping the order in which they were added
+        for sheet_name, sheet_fields in structure.items():
+            if sheet_name not in self.output_structure:
+                self.output_structure[sheet_name] = list(sheet_fields)
+                continue
+
+            sheet_columns = self.sheet_columns(sheet_name)
+            for field in sheet_fields:
+                if field not in sheet_columns:
+                    self.output_structure[sheet_name].append(field)
+                    sheet_columns.add(field)
+
+    def iter_form_rows(self, form_id, screen_nodes):
+        """
+        Iterate over the submissions of a form as (sheet_name, row) tuples, as they are processed
+
+        The sheet columns are added to self.output_structure as the rows are generated, so it is complete once the rows are consumed
+        """
+        for submission in self.iter_form_submissions(form_id, screen_nodes):
+            yield from self.iter_sheet_rows(submission, 'main')
+
+    def iter_sheet_rows(self, record, sheet_name):
+        """
+        Split a processed submission into the rows of its sheets, the same way as the Excel export
+
+        The record is yielded first with a 'Check <sheet>' link in place of each repeat, followed by the rows of its repeats
+        """
+        row = {}
+        repeats = []
+        for field, value in record.items():
+            if isinstance(value, list):
+                row[field] = 'Check ' + field
+                repeats.append((field, value))
+            else:
+                row[field] = value
+
+        yield (sheet_name, row)
+
+        for field, items in repeats:
+            for item in self.iter_repeat_items(items):
+                yield from self.iter_sheet_rows(item, field)
+
+    def iter_repeat_items(self, items):
+        # the items of a repeat, with the nested lists flattened. Only the processed nodes can be rows of a sheet
+        for item in items:
+            if isinstance(item, dict):
+                yield item
+            elif isinstance(item, list):
+                yield from self.iter_repeat_items(item)
+
+    def get_flatten_plan(self, form_id):
+        """
+        Get the compiled flatten plan of a form, which maps the raw keys of its submissions to their clean names, sheets and declared types
+
+        The plans are cached by (form_id, form_version), so the saved structure is only loaded when the form is first flattened
+        """
+        form_version = ODKForm.objects.filter(form_id=form_id).values_list('form_version', flat=True).first()
+        (is_found, flatten_plan) = flatten_plans_cache.lookup((form_id, form_version))
+        if is_found:
+            return flatten_plan
+
+        form_structure = ODKForm.objects.filter(form_id=form_id).values_list('structure', flat=True).first()
+        flatten_plan = self.compile_flatten_plan(form_structure) if form_structure is not None else {}
+        flatten_plans_cache.set((form_id, form_version), flatten_plan)
+        return flatten_plan
+
+    def compile_flatten_plan(self, form_structure):
+        """
+        Walk the form structure and map the full path of each question, eg group/repeat/question, to a tuple of
+        (clean key, sheet name, declared XForm type). The questions of a repeat are saved in the sheet named after the repeat
+        """
+        flatten_plan = {}
+
+        def add_children(parent_node, parent_path, sheet_name):
+            for node in parent_node.get('children', []):
+                # the choices of a select don't have a type
+                if 'type' not in node or 'name' not in node:
+                    continue
+
+                key_path = node['name'] if parent_path is None else '%s/%s' % (parent_path, node['name'])
+                try:
+                    clean_key = clean_json_key(key_path)
+                except IndexError:
+                    # the key can't be cleaned, so leave it to the flattener
+                    continue
+
+                flatten_plan[key_path] = (clean_key, sheet_name, node['type'])
+                if node['type'] == 'repeat':
+                    add_children(node, key_path, clean_key)
+                elif node['type'] == 'group':
+                    add_children(node, key_path, sheet_name)
+
+        add_children(form_structure, None, 'main')
+        return flatten_plan
+
+    def sheet_columns(self, sheet_name):
+        # the set of the columns in the sheet, kept in step with the list in output_structure
+        sheet_columns = self.output_columns.get(sheet_name)
+        if sheet_columns is None or len(sheet_columns) != len(self.output_structure[sheet_name]):
+            sheet_columns = set(self.output_structure[sheet_name])
+            self.output_columns[sheet_name] = sheet_columns
+
+        return sheet_columns
 
     def process_node(self, node, sheet_name, nodes_of_interest=None, add_top_id=True):
         # the sheet_name is the name of the sheet where the current data will be saved
+        # the keys are cleaned using the form's flatten plan. The answers of the declared questions are classified from their
+        # declared type, and the other values are classified without relying on exceptions
         cur_node = {}
+        flatten_plan = self.flatten_plan
+        top_id = self.pk_name + str(self.indexes['main'])
 
-        for key, value in list(node.items()):
+        for key, value in node.items():
             # clean the key
-            clean_key = self.clean_json_key(key)
+            planned_key = flatten_plan.get(key)
+            clean_key = planned_key[0] if planned_key is not None else clean_json_key(key)
             if clean_key == '_geolocation':
                 continue
 
@@ -829,14 +1423,23 @@ class OdkForms():
                     continue
 
             # add this key to the sheet name
-            if clean_key not in self.output_structure[sheet_name]:
+            sheet_columns = self.sheet_columns(sheet_name)
+            if clean_key not in sheet_columns:
                 self.output_structure[sheet_name].append(clean_key)
+                sheet_columns.add(clean_key)
 
             if clean_key in self.country_qsts:
                 value = self.get_clean_country_code(value)
 
             is_json = True
-            val_type = self.determine_type(value)
+            value_class = type(value)
+            if planned_key is not None and value_class is str and planned_key[2] not in structural_types:
+                # the answer of a question is kept as it is, without sniffing whether it is a number or a JSON document
+                val_type = 'is_string'
+            elif planned_key is not None and value_class is list and planned_key[2] == 'repeat':
+                val_type = 'is_list'
+            else:
+                val_type = self.classify_value(value)
 
             if val_type == 'is_list':
                 value = self.process_list(value, clean_key, node['unique_id'])
@@ -854,30 +1457,36 @@ class OdkForms():
                 is_json = False
 
             if is_json is True:
-                node_value = self.process_node(value, clean_key, nodes_of_interest)
-                cur_node[clean_key] = node_value
+                cur_node[clean_key] = self.process_node(value, clean_key, nodes_of_interest)
             else:
-                node_value = value
                 cur_node[clean_key] = value
 
-            """
-            if nodes_of_interest is not None:
-                # at this point, we have our data, no need to check if we have the right key
-                terminal.tprint("\tAdding the processed node (%s)" % clean_key, 'ok')
-                if clean_key not in self.sections_of_interest:
-                    self.sections_of_interest[clean_key] = []
-
-                if isinstance(node_value, list):
-                    for node_item in node_value:
-                        self.sections_of_interest[clean_key].append(node_item)
-                else:
-                    self.sections_of_interest[clean_key].append(node_value)
-            """
             if add_top_id is True:
-                cur_node['top_id'] = self.pk_name + str(self.indexes['main'])
+                cur_node['top_id'] = top_id
 
         return cur_node
 
+    def classify_value(self, value):
+        """
+        Classify a value the same way as determine_type, but with type checks for the common values instead of exceptions
+        """
+        value_class = type(value)
+        if value_class is str:
+            # a string which can't start a number or a JSON document is a plain string
+            first_char = value.lstrip()[:1]
+            if first_char == '' or first_char in plain_string_starts:
+                return 'is_string'
+        elif value_class is int or value_class is float or value_class is bool:
+            return 'is_int'
+        elif value_class is list:
+            return 'is_list'
+        elif value_class is dict:
+            return 'is_json'
+        elif value is None:
+            return 'is_none'
+
+        return self.determine_type(value)
+
     def determine_type(self, input):
         """
         determine the input from the user
@@ -928,7 +1537,7 @@ class OdkForms():
 
         cur_list = []
         for node in list:
-            val_type = self.determine_type(node)
+            val_type = self.classify_value(node)
             node['unique_id'] = sheet_name + '_' + str(self.indexes[sheet_name])
 
             if val_type == 'is_json':
@@ -956,49 +1565,19 @@ class OdkForms():
 
     def clean_json_key(self, j_key):
         # given a key from ona with data, get the sane(last) part of the key
-        m = re.findall("/?(\w+)$", j_key)
-        return m[0]
+        return clean_json_key(j_key)
 
     def get_clean_country_code(self, code):
-        if self.clean_country_codes is None:
-            terminal.tprint('Adding the list of country codes', 'okblue')
-            self.clean_country_codes = {}
-
+        # get the country name of a country code, or the code itself if it isn't defined in the settings
+        if self.country_matcher is None:
             try:
-                # get the country codes to clean
-                settings = ConfigParser()
-                settings.read(self.forms_settings)
-                country_codes = settings.items('countries')
-                for country, c_code in country_codes:
-                    if re.search(",", c_code) is not None:
-                        c_code = c_code.split(',')
-                        for t_code in c_code:
-                            self.clean_country_codes[t_code] = country
-                    else:
-                        self.clean_country_codes[c_code] = country
-
+                terminal.tprint('Adding the list of country codes', 'okblue')
+                self.country_matcher = form_registry.get_country_matcher()
             except Exception as e:
                 terminal.tprint(str(e), 'fail')
                 return code
 
-        # it seems we have our countries processed, just get the clean code
-        try:
-            if code in self.clean_country_codes:
-                return self.clean_country_codes[code]
-            else:
-                for c_code, country in list(self.clean_country_codes.items()):
-                    if re.search(c_code, code, re.IGNORECASE) is not None:
-                        return country
-
-                # if we are still here, the code wasnt found
-                terminal.tprint("Couldn't find (%s) in the settings" % code, 'fail')
-                # terminal.tprint(c_code + '--' + country, 'okblue')
-                print((self.clean_country_codes))
-                print('')
-                return code
-        except Exception as e:
-            terminal.tprint(str(e), 'fail')
-            return code
+        return self.country_matcher.resolve(code)
 
     def process_single_submission(self, node, watch_list):
         # given a node full of submission and a watchlist,
@@ -1014,7 +1593,7 @@ class OdkForms():
         headers = {'Authorization': "Token %s" % self.api_token}
         # terminal.tprint("Processing API request %s" % url, 'okblue')
         try:
-            r = requests.get(url, headers=headers)
+            r = self.client.get(url, headers=headers)
         except Exception as e:
             logger.error(traceback.format_exc())
             logger.info(str(e))
@@ -1032,23 +1611,164 @@ class OdkForms():
 
             return None
 
-    def fetch_form_metadata(self, url, download_properties):
-        # stream the download and save the file to the specified place
+    def process_streamed_request(self, url, is_missing_empty=False):
+        """
+        Execute a GET request whose response is a JSON array and iterate over the items as they are received
+
+        Returns None if the request fails. When is_missing_empty is True, a 404 response is an empty array
+        """
+        headers = {'Authorization': "Token %s" % self.api_token}
         try:
-            headers = {'Authorization': "Token %s" % self.api_token}
-            r = requests.get(url, headers=headers, stream=True)
+            r = self.client.get(url, headers=headers, stream=True)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.info(str(e))
+            return None
 
-            if r.status_code == 200:
-                # print(r.content)
-                f = open(download_properties['path_to_save'], 'wt')
-                f.write(r.content.decode('utf-8'))
-            else:
-                terminal.tprint("Response %d" % r.status_code, 'fail')
-                raise SuspiciousOperation('File download failed with the status code %d' % r.status_code)
+        if r.status_code == 404 and is_missing_empty:
+            r.close()
+            return iter([])
+
+        if r.status_code != 200:
+            terminal.tprint("Response %d" % r.status_code, 'fail')
+            terminal.tprint(r.text, 'fail')
+            return None
+
+        return iter_json_array(iter_response_text(r))
+
+    def process_curl_requests(self, urls, concurrency=None):
+        """
+        Execute several GET requests concurrently. The responses are returned in the order of the urls, with None for the failed requests
+        """
+        headers = {'Authorization': "Token %s" % self.api_token}
+        return AsyncOnaClient(self.client, concurrency).fetch_many(urls, headers)
+
+    def fetch_forms_resources(self, form_ids, concurrency=None):
+        """
+        Fetch the structures and the metadata of several forms at once
+
+        Returns a dict keyed by the form id with the 'structure' and the 'metadata' of each form, which are None when their request failed
+        """
+        urls = []
+        for form_id in form_ids:
+            urls.append("%s/%s%d/form.json" % (self.server, self.form_rep, form_id))
+            urls.append("%s/%s?xform=%d" % (self.server, self.metadata_uri, form_id))
+
+        responses = self.process_curl_requests(urls, concurrency)
+        all_resources = {}
+        for i, form_id in enumerate(form_ids):
+            all_resources[form_id] = {'structure': responses[2 * i], 'metadata': responses[2 * i + 1]}
+
+        return all_resources
+
+    def backfill_forms(self, form_ids=None, concurrency=None):
+        """
+        Download the structures, the metadata and the submissions of many forms, eg when onboarding a new county
+
+        The forms list is refreshed first, then the structures and the metadata of the forms are fetched concurrently and the
+        submissions are synced by a pool of workers. All the forms listed on onadata are backfilled when form_ids is None.
+        Returns the ids of the forms which couldn't be backfilled
+        """
+        # the structures are fetched below with the other resources of the forms
+        all_forms = self.refresh_forms(process_structures=None)
+        if all_forms is None:
+            raise Exception("There was an error while fetching the list of forms")
+        if form_ids is None:
+            form_ids = [int(form['id']) for form in all_forms if form['id'] != '-1']
+
+        terminal.tprint("Fetching the structures and the metadata of %d forms" % len(form_ids), 'header')
+        all_resources = self.fetch_forms_resources(form_ids, concurrency)
+        saved_forms = {odk_form.form_id: odk_form for odk_form in ODKForm.objects.filter(form_id__in=form_ids)}
+        failed_ids = []
+        for form_id in form_ids:
+            form_resources = all_resources[form_id]
+            if form_id not in saved_forms or form_resources['structure'] is None or form_resources['metadata'] is None:
+                terminal.tprint("\tThe resources of the form with id %d couldn't be fetched" % form_id, 'fail')
+                failed_ids.append(form_id)
+                continue
+
+            try:
+                cur_form = saved_forms[form_id]
+                processed_nodes = self.process_form_structure(form_resources['structure'], form_id)
+                self.save_form_structure(cur_form, processed_nodes, form_resources['structure'])
+                form_structures_cache.set((form_id, cur_form.form_version), processed_nodes)
+                if not self.process_form_metadata(form_resources['metadata'], form_id):
+                    failed_ids.append(form_id)
+            except Exception as e:
+                terminal.tprint("Error while processing the structure of the form %d: %s" % (form_id, str(e)), 'fail')
+                sentry.captureException()
+                failed_ids.append(form_id)
+
+        try:
+            # the submissions of the forms without a structure can still be synced
+            sync_forms_submissions([form_id for form_id in form_ids if form_id in saved_forms])
+            failed_ids.extend([form_id for form_id in form_ids if form_id in saved_forms and form_id not in synced_forms and form_id not in failed_ids])
+        finally:
+            synced_forms.clear()
+
+        return failed_ids
+
+    def fetch_form_metadata(self, url):
+        # start downloading the file
+        # returns the streamed response, or None if the file hasn't changed since it was last processed
+        try:
+            (is_modified, r) = self.process_conditional_request(url, stream=True)
+
+            if r is None:
+                raise SuspiciousOperation('File download from %s failed' % url)
+            elif not is_modified:
+                return None
+
+            return r
         except Exception:
             sentry.captureException()
             raise
 
+    def process_conditional_request(self, url, use_validators=True, stream=False):
+        """
+        Execute a GET request, sending the validators saved from the last processed response of the url
+
+        Returns a tuple (is_modified, response) and the response is None when the request fails. A 304 response or a response
+        with the same content hash as the last processed one is not modified. Once a modified response is processed, its
+        validators should be saved using save_request_validators. The body of a streamed response is not read, so only
+        a 304 response is not modified
+        """
+        headers = {'Authorization': "Token %s" % self.api_token}
+        cached = OnaRequestCache.objects.filter(url=url).first() if use_validators else None
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        try:
+            r = self.client.get(url, headers=headers, stream=stream)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.info(str(e))
+            return (False, None)
+
+        if r.status_code == 304:
+            return (False, r)
+        elif r.status_code != 200:
+            terminal.tprint("Response %d" % r.status_code, 'fail')
+            terminal.tprint(r.text, 'fail')
+            return (False, None)
+
+        if not stream and cached is not None and cached.content_hash == hashlib.sha1(r.content).hexdigest():
+            return (False, r)
+
+        return (True, r)
+
+    def save_request_validators(self, url, r, content_hash=None):
+        # save the validators of a processed response, for use in the next conditional request of the url
+        # the content hash of a streamed response is computed as it is read, so it is passed in
+        OnaRequestCache.objects.update_or_create(url=url, defaults={
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'content_hash': content_hash if content_hash is not None else hashlib.sha1(r.content).hexdigest()
+        })
+
     def get_views_info(self):
         form_views = FormViews.objects.all()
 
@@ -1438,8 +2158,9 @@ class OdkForms():
 
                 all_syndromes_freq[t_synd] += 1
 
+        labels = self.get_values_from_dictionary(list(all_syndromes_freq.keys()))
         for t_synd, freq in list(all_syndromes_freq.items()):
-            tt_synd = str(self.get_value_from_dictionary(t_synd))
+            tt_synd = labels[t_synd]
             all_syndromes.append({'text': tt_synd, 'size': freq * 8})
 
         # terminal.tprint(json.dumps(all_syndromes), 'warn')
@@ -1472,8 +2193,9 @@ class OdkForms():
 
                 all_diseases_freq[t_synd] += 1
 
+        labels = self.get_values_from_dictionary(list(all_diseases_freq.keys()))
         for t_synd, freq in list(all_diseases_freq.items()):
-            tt_synd = str(self.get_value_from_dictionary(t_synd))
+            tt_synd = labels[t_synd]
             all_diseases.append({'text': tt_synd, 'size': freq * 8})
 
         # terminal.tprint(json.dumps(all_diseases), 'warn')
@@ -1861,8 +2583,9 @@ class OdkForms():
 
                 all_syndromes_freq[t_synd] += 1
 
+        labels = self.get_values_from_dictionary(list(all_syndromes_freq.keys()))
         for t_synd, freq in list(all_syndromes_freq.items()):
-            tt_synd = str(self.get_value_from_dictionary(t_synd))
+            tt_synd = labels[t_synd]
             all_syndromes.append({'text': tt_synd, 'size': freq * 8})
 
         # terminal.tprint(json.dumps(all_syndromes), 'warn')
@@ -1897,6 +2620,7 @@ class OdkForms():
             cursor.execute(nd_all_reports_q)
             reports = cursor.fetchall()
 
+        labels = self.get_values_from_dictionary([rep[i] for rep in reports for i in (11, 12, 18, 20)])
         all_reports = []
         for rep in reports:
             all_reports.append({
@@ -1911,16 +2635,16 @@ class OdkForms():
                 'report_date': str(rep[8]),
                 'disease': str(rep[9]),
                 'species': str(rep[10]),
-                'type_diagnosis': self.get_value_from_dictionary(rep[11]),
-                'prod_system': self.get_value_from_dictionary(rep[12]),
+                'type_diagnosis': labels.get(rep[11], str(rep[11])),
+                'prod_system': labels.get(rep[12], str(rep[12])),
                 'is_zoonotic': str(rep[13]),
                 'no_risk': int(rep[14]),
                 'no_sick': int(rep[15]),
                 'no_dead': int(rep[16]),
                 'no_slaughtered': int(rep[17]),
-                'measures': self.get_value_from_dictionary(rep[18]),
+                'measures': labels.get(rep[18], str(rep[18])),
                 'no_vaccinated': 'N/A' if rep[19] is None else int(rep[19]),
-                'org': self.get_value_from_dictionary(rep[20]),
+                'org': labels.get(rep[20], str(rep[20])),
             })
 
         nd_count = len(nd_reporting)
@@ -1976,6 +2700,7 @@ class OdkForms():
             cursor.execute(ag_all_reports_q)
             reports = cursor.fetchall()
 
+        labels = self.get_values_from_dictionary([rep[9] for rep in reports])
         all_reports = []
         for rep in reports:
             all_reports.append({
@@ -1988,7 +2713,7 @@ class OdkForms():
                 'accuracy': str(rep[6]),
                 'syndrome': str(rep[7]),
                 'syndrome_start_date': str(rep[8]),
-                'drug_sold': self.get_value_from_dictionary(rep[9]),
+                'drug_sold': labels.get(rep[9], str(rep[9])),
                 'drug_quantity': str(rep[10]),
                 'farmer_location': str(rep[11]),
             })
@@ -2045,6 +2770,7 @@ class OdkForms():
             cursor.execute(sh_all_reports_q)
             reports = cursor.fetchall()
 
+        labels = self.get_values_from_dictionary([rep[10] for rep in reports])
         all_reports = []
         for rep in reports:
             all_reports.append({
@@ -2058,7 +2784,7 @@ class OdkForms():
                 'no_slaughtered': int(rep[7]),
                 'carcas_no_condemned': int(rep[8]),
                 'body_part': str(rep[9]),
-                'lesions': str(rep[10]),
+                'lesions': labels.get(rep[10], str(rep[10])),
                 'part_no_condemned': int(rep[11]),
                 'sample_collected': str(rep[12]),
             })
@@ -2197,15 +2923,136 @@ class OdkForms():
 
 ordinal = lambda n: "%d%s" % (n, "tsnrhtdd"[(n/10%10!=1)*(n%10<4)*n%10::4])
 
+# the characters which can start neither a number, eg 12, -1.5, inf or nan, nor a JSON document, eg true, null, {, [ or "
+plain_string_starts = frozenset(string.ascii_letters + string.punctuation) - frozenset('tfnNiI+-.{["')
+json_key_regex = re.compile(r"/?(\w+)$")
+# the XForm types of the questions which hold other questions, the other types are answered with a value
+structural_types = frozenset(['repeat', 'group'])
+
+
+@functools.lru_cache(maxsize=10000)
+def clean_json_key(j_key):
+    # given a key from ona with data, get the sane(last) part of the key. The keys are repeated in every submission, so they are memoised
+    m = json_key_regex.findall(j_key)
+    return m[0]
+
+
+class IteratorFile(io.TextIOBase):
+    """
+    A read only file over an iterator of strings, eg for streaming generated rows to COPY FROM STDIN
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if '\n' not in self.buffer:
+            self.buffer += next(self.lines, '')
+        return self.read(self.buffer.index('\n') + 1 if '\n' in self.buffer else -1)
+
 
 # lets capture the missing information when processing and then send a notification to the admin
 missing_info = {}
+# the forms whose submissions have already been synced in the current processing run
+synced_forms = set()
+
+
+# the chunks of submissions processed by the forked flattening processes, see OdkForms.iter_flattened_chunks
+flatten_job = {}
+
+
+def flatten_chunk(job):
+    # process a chunk of submissions using its reserved ids, returns the processed submissions and the resulting sheet columns
+    (chunk, chunk_indexes) = job
+    odk_forms = flatten_job['odk_forms']
+    odk_forms.indexes.update(chunk_indexes)
+    # add the new sheets beforehand, else process_list would number their rows from 1
+    for sheet_name in chunk_indexes:
+        if sheet_name not in odk_forms.output_structure:
+            odk_forms.output_structure[sheet_name] = ['unique_id', 'top_id', 'parent_id']
+
+    try:
+        processed_chunk = []
+        for data in chunk:
+            data['unique_id'] = odk_forms.pk_name + str(odk_forms.indexes['main'])
+            processed_chunk.append(odk_forms.process_node(data, 'main', flatten_job['nodes_of_interest'], False))
+            odk_forms.indexes['main'] += 1
+    finally:
+        # don't keep a database connection opened while processing the chunk
+        connection.close()
+
+    return (processed_chunk, odk_forms.output_structure)
+
+
+def process_forms_structures(form_ids):
+    # process the structures of newly registered forms, it can run in a background thread
+    try:
+        odk_forms = OdkForms(None)
+        for form_id in form_ids:
+            try:
+                odk_forms.get_form_structure_as_json(form_id)
+            except Exception as e:
+                terminal.tprint("Error while processing the structure of the form %s: %s" % (str(form_id), str(e)), 'fail')
+                sentry.captureException()
+    finally:
+        connection.close()
+
+
+def sync_form_submissions(form_id):
+    # runs in a worker thread, so it uses its own OdkForms instance and database connection
+    try:
+        odk_forms = OdkForms(None)
+        # raise the errors, so that a form which failed to sync isn't marked as synced
+        odk_forms.get_all_submissions(form_id, raise_errors=True)
+    finally:
+        # django opens a new connection for each thread, so close it when done
+        connection.close()
+
+
+def sync_forms_submissions(form_ids, max_workers=None):
+    """
+    Sync the submissions of the forms from onadata using a bounded pool of workers
+
+    Most of the time is spent waiting on onadata, so the forms are fetched concurrently. The number of workers
+    defaults to the ONA_SYNC_WORKERS setting
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'ONA_SYNC_WORKERS', 4)
+
+    terminal.tprint("Syncing the submissions of %d forms using %d workers" % (len(form_ids), max_workers), 'warn')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(sync_form_submissions, form_id): form_id for form_id in form_ids}
+        for future in as_completed(pending):
+            try:
+                future.result()
+                synced_forms.add(pending[future])
+            except Exception as e:
+                terminal.tprint("Error while syncing the submissions of the form %s: %s" % (str(pending[future]), str(e)), 'fail')
+                sentry.captureException()
+
+
 def auto_process_submissions():
     terminal.tprint('Starting the auto process function', 'warn')
     odk_forms = OdkForms(None)
 
     # get all the forms and process the forms matching the criteria like 'dsf'
-    all_forms = odk_forms.refresh_forms()
+    # the structures are processed inline, since the submissions of the new forms are processed right after
+    all_forms = odk_forms.refresh_forms(process_structures='inline')
     if all_forms is None: return None
     syndromic_forms = []
     nd_forms = []
@@ -2224,11 +3071,22 @@ def auto_process_submissions():
         elif re.search("agrovets_", form['full_id']) is not None:
             agrovet_forms.append(form['id'])
 
-    # lets process the syndromic submissions
-    process_syndromic_submissions(syndromic_forms)
-    process_notifiable_diseases(nd_forms)
-    process_agrovet_records(agrovet_forms)
-    process_abattoir_records_v1(abattoir_forms)
+    try:
+        # fetch the new submissions of all the forms before processing them
+        sync_forms_submissions(syndromic_forms + nd_forms + abattoir_forms + agrovet_forms)
+
+        # lets process the syndromic submissions
+        process_syndromic_submissions(syndromic_forms)
+        process_notifiable_diseases(nd_forms)
+        process_agrovet_records(agrovet_forms)
+        process_abattoir_records_v1(abattoir_forms)
+    finally:
+        # the next run should sync the forms again, even when this one failed
+        synced_forms.clear()
+
+    # show the cost of the onadata calls made in this run
+    terminal.tprint('Onadata requests made in this run', 'header')
+    odk_forms.client.print_stats()
 
     # loop through the missing information and create an email to the admin
     try:
@@ -2282,11 +3140,8 @@ def process_syndromic_submissions(form_ids):
     terminal.tprint('\n\nProcessing syndromes...', 'warn')
     odk_forms = OdkForms(None)
 
-    all_submissions = []
-    for form_id in form_ids:
-        this_submissions = odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None)
-        if(isinstance(this_submissions, list)):
-            all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+    # the submissions of all the forms are processed as they are read
+    all_submissions = itertools.chain.from_iterable(odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None) for form_id in form_ids)
 
     # terminal.tprint(json.dumps(all_submissions), 'ok')
     # if there is no GPS to use, default to use ILRI's GPS coordinates
@@ -2408,11 +3263,8 @@ def process_notifiable_diseases(form_ids):
     terminal.tprint('\n\nProcessing notifiable diseases submissions...', 'warn')
     odk_forms = OdkForms(None)
 
-    all_submissions = []
-    for form_id in form_ids:
-        this_submissions = odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None)
-        if(isinstance(this_submissions, list)):
-            all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+    # the submissions of all the forms are processed as they are read
+    all_submissions = itertools.chain.from_iterable(odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None) for form_id in form_ids)
 
     # terminal.tprint(json.dumps(all_submissions), 'ok')
     # if there is no GPS to use, default to use ILRI's GPS coordinates
@@ -2517,11 +3369,8 @@ def process_abattoir_records_v1(form_ids):
     terminal.tprint('\n\nProcessing abattoir submissions...', 'warn')
     odk_forms = OdkForms(None)
 
-    all_submissions = []
-    for form_id in form_ids:
-        this_submissions = odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None)
-        if(isinstance(this_submissions, list)):
-            all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+    # the submissions of all the forms are processed as they are read
+    all_submissions = itertools.chain.from_iterable(odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None) for form_id in form_ids)
 
     # terminal.tprint(json.dumps(all_submissions), 'ok')
     # if there is no GPS to use, default to use ILRI's GPS coordinates
@@ -2648,11 +3497,8 @@ def process_agrovet_records(form_ids):
     terminal.tprint('\n\nProcessing agrovet submissions...', 'warn')
     odk_forms = OdkForms(None)
 
-    all_submissions = []
-    for form_id in form_ids:
-        this_submissions = odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None)
-        if(isinstance(this_submissions, list)):
-            all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+    # the submissions of all the forms are processed as they are read
+    all_submissions = itertools.chain.from_iterable(odk_forms.fetch_merge_data(form_id, None, 'json', 'submissions', None) for form_id in form_ids)
 
     # terminal.tprint(json.dumps(all_submissions), 'ok')
     # if there is no GPS to use, default to use ILRI's GPS coordinates
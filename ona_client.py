@@ -0,0 +1,282 @@
+"""A shared HTTP client for all the onadata API calls
+
+The client keeps a pool of keep-alive connections to the onadata server, uses timeouts on all the requests,
+retries throttled and failed idempotent requests with a jittered exponential backoff and keeps the latency
+statistics of the requests that have been made
+"""
+import re
+import json
+import time
+import codecs
+import random
+import asyncio
+import functools
+import threading
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from .terminal_output import Terminal
+
+terminal = Terminal()
+
+
+class OnaClient():
+    # the requests which are safe to be repeated
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    # the status codes that are worth retrying
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, max_retries=None, backoff_factor=None, max_backoff=None):
+        self.pool_size = pool_size if pool_size is not None else getattr(settings, 'ONA_POOL_SIZE', 10)
+        connect_timeout = connect_timeout if connect_timeout is not None else getattr(settings, 'ONA_CONNECT_TIMEOUT', 10)
+        read_timeout = read_timeout if read_timeout is not None else getattr(settings, 'ONA_READ_TIMEOUT', 120)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'ONA_MAX_RETRIES', 3)
+        self.backoff_factor = backoff_factor if backoff_factor is not None else getattr(settings, 'ONA_BACKOFF_FACTOR', 0.5)
+        self.max_backoff = max_backoff if max_backoff is not None else getattr(settings, 'ONA_MAX_BACKOFF', 30)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Execute a request against the onadata server, retrying the idempotent requests on connection errors and on 429/5xx responses
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self.endpoint_name(url)
+        can_retry = method.upper() in self.idempotent_methods
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_request(endpoint, time.monotonic() - started, None)
+                if not can_retry or attempt >= self.max_retries:
+                    raise
+                terminal.tprint("%s %s failed (%s), retrying..." % (method, endpoint, str(e)), 'warn')
+                delay = self.backoff_delay(attempt)
+            else:
+                self.record_request(endpoint, time.monotonic() - started, r.status_code)
+                if not can_retry or r.status_code not in self.retry_statuses or attempt >= self.max_retries:
+                    return r
+                terminal.tprint("%s %s responded with %d, retrying..." % (method, endpoint, r.status_code), 'warn')
+                delay = self.backoff_delay(attempt, r.headers.get('Retry-After'))
+                r.close()
+
+            time.sleep(delay)
+            attempt += 1
+
+    def backoff_delay(self, attempt, retry_after=None):
+        # honour the server's Retry-After when it is given in seconds, else use a full jitter exponential backoff
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def endpoint_name(self, url):
+        # group the requests by their path, with the numerical ids masked, eg api/v1/data/:id
+        path = urlparse(url).path.strip('/')
+        return re.sub(r'(^|/)\d+(?=/|\.|$)', r'\1:id', path)
+
+    def record_request(self, endpoint, duration, status_code):
+        with self.stats_lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = {'count': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+            cur_stats = self.stats[endpoint]
+            cur_stats['count'] += 1
+            cur_stats['total_time'] += duration
+            cur_stats['max_time'] = max(cur_stats['max_time'], duration)
+            if status_code is None or status_code >= 400:
+                cur_stats['errors'] += 1
+
+    def get_stats(self):
+        """
+        Get the latency statistics of the requests made, grouped by the endpoint
+        """
+        with self.stats_lock:
+            all_stats = {}
+            for endpoint, cur_stats in self.stats.items():
+                all_stats[endpoint] = dict(cur_stats)
+                all_stats[endpoint]['avg_time'] = cur_stats['total_time'] / cur_stats['count']
+
+        return all_stats
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+    def print_stats(self):
+        for endpoint, cur_stats in sorted(self.get_stats().items(), key=lambda x: x[1]['total_time'], reverse=True):
+            terminal.tprint("\t%s: %d requests, %d errors, %.2fs total, %.3fs avg, %.3fs max" % (endpoint, cur_stats['count'], cur_stats['errors'], cur_stats['total_time'], cur_stats['avg_time'], cur_stats['max_time']), 'info')
+
+
+class AsyncOnaClient():
+    """
+    Fans out GET requests to onadata from an asyncio event loop, with at most `concurrency` requests in flight
+
+    The requests go through the pooled OnaClient, so they share its connections, retries and statistics
+    """
+    def __init__(self, client=None, concurrency=None):
+        self.client = client if client is not None else get_ona_client()
+        self.concurrency = concurrency if concurrency is not None else getattr(settings, 'ONA_ASYNC_CONCURRENCY', 10)
+
+    async def fetch_json(self, url, headers, semaphore, executor):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                r = await loop.run_in_executor(executor, functools.partial(self.client.get, url, headers=headers))
+            except Exception as e:
+                terminal.tprint("Error while fetching %s: %s" % (url, str(e)), 'fail')
+                return None
+
+        if r.status_code != 200:
+            terminal.tprint("Response %d: %s" % (r.status_code, r.text), 'fail')
+            return None
+
+        return r.json()
+
+    async def fetch_all(self, urls, headers=None):
+        """
+        Fetch the urls concurrently. The responses are returned in the order of the urls, with None for the failed requests
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return await asyncio.gather(*[self.fetch_json(url, headers, semaphore, executor) for url in urls])
+
+    def fetch_many(self, urls, headers=None):
+        """
+        Synchronous wrapper of fetch_all, for use outside an event loop, eg in the management commands
+        """
+        return asyncio.run(self.fetch_all(urls, headers))
+
+
+def iter_response_text(r, chunk_size=65536, content_hash=None):
+    """
+    Iterate over the body of a streamed response as decoded text chunks
+
+    When a hashlib object is given as content_hash, it is updated with the raw body as it is received. The body is decoded as
+    utf-8 unless the response declares its charset, since requests assumes ISO-8859-1 for the text/* responses without one
+    """
+    has_charset = 'charset' in r.headers.get('content-type', '').lower()
+    decoder = codecs.getincrementaldecoder((r.encoding if has_charset else None) or 'utf-8')(errors='replace')
+    for chunk in r.iter_content(chunk_size=chunk_size):
+        if content_hash is not None:
+            content_hash.update(chunk)
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_text_lines(chunks):
+    """
+    Split an iterable of text chunks into lines on '\\n', keeping the line endings
+    """
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split('\n')
+        # the last line might not be complete yet
+        buffer = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    if buffer:
+        yield buffer
+
+
+# the characters which can continue a number, so a number followed by one of them might not be complete
+number_chars = frozenset('0123456789.eE+-')
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally parse a JSON array from an iterable of text chunks, yielding each item as soon as it is complete
+
+    Only the current item is held in memory, so large responses can be processed as they are received
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    is_started = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            # skip the whitespace and the separators between the items
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+
+            if not is_started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array, got %s' % buffer[pos:pos + 50])
+                is_started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the item is not complete, wait for more data
+                break
+
+            if end == len(buffer) or (isinstance(item, (int, float)) and not isinstance(item, bool) and buffer[end] in number_chars):
+                # a number at the end of the buffer might still have more digits, a fraction or an exponent coming, eg 3. or 1e
+                break
+
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    raise ValueError('The JSON array is incomplete')
+
+
+shared_client = None
+shared_client_lock = threading.Lock()
+
+
+def get_ona_client():
+    """
+    Get the onadata client shared by the whole process
+    """
+    global shared_client
+    if shared_client is None:
+        with shared_client_lock:
+            if shared_client is None:
+                shared_client = OnaClient()
+
+    return shared_client
@@ -1,4 +1,3 @@
-import requests
 import traceback
 import re
 
@@ -7,6 +6,7 @@ from django.conf import settings
 from raven import Client
 
 from .terminal_output import Terminal
+from .ona_client import get_ona_client
 
 terminal = Terminal()
 sentry = Client(settings.SENTRY_DSN)
@@ -19,6 +19,7 @@ class Onadata():
         self.server = server_url
         self.api_token = token
         self.headers = {'Authorization': "Token %s" % self.api_token}
+        self.client = get_ona_client()
 
         # endpoints
         self.api_all_forms = 'api/v1/forms'
@@ -45,7 +46,7 @@ class Onadata():
         """
         # terminal.tprint("Processing API request %s" % url, 'okblue')
         try:
-            r = requests.get(url, headers=self.headers)
+            r = self.client.get(url, headers=self.headers)
             if r.status_code == 200:
                 return r.json()
             else:
@@ -66,7 +67,7 @@ class Onadata():
         try:
             url = '%s/%s' % (self.server, 'api/v1/profiles')
             # print('Executing the url %s' % url)
-            r = requests.post(url, user_details, headers=self.headers)
+            r = self.client.post(url, user_details, headers=self.headers)
             if r.status_code == 201:
                 return r.json()
             else:
@@ -87,7 +88,7 @@ class Onadata():
         try:
             url = '%s/%s' % (self.server, 'api/v1/projects')
             xls_headers = {'Authorization': "Token %s" % api_token}
-            r = requests.post(url, org_details, headers=xls_headers)
+            r = self.client.post(url, org_details, headers=xls_headers)
             if settings.DEBUG: print(r.json())
             if r.status_code == 201:
                 return r.json()
@@ -107,7 +108,7 @@ class Onadata():
         try:
             url = '%s/%s' % (self.server, 'api/v1/projects')
             xls_headers = {'Authorization': "Token %s" % api_token}
-            r = requests.post(url, project_details, headers=xls_headers)
+            r = self.client.post(url, project_details, headers=xls_headers)
             if settings.DEBUG: print(r.json())
             if r.status_code == 201:
                 return r.json()
@@ -146,7 +147,7 @@ class Onadata():
 
                 # check if we have metadata
                 meta_url = '%s/%s?xform=%s' % (self.server, self.metadata_uri, form['formid'])
-                meta_r = requests.get(meta_url, headers=self.headers)
+                meta_r = self.client.get(meta_url, headers=self.headers)
                 # print("Fetching meta response code %s" % meta_r.status_code)
                 if meta_r.status_code != 200:
                     terminal.tprint("Response %d: %s" % (meta_r.status_code, meta_r.text), 'fail')
@@ -160,7 +161,7 @@ class Onadata():
                         # to delete a metadata, I need super privileges, something I can't figure out for now
                         # so lets use the master token
                         master_headers = {'Authorization': "Token %s" % settings.ONADATA_MASTER}
-                        del_r = requests.delete(delete_url, headers=master_headers)
+                        del_r = self.client.delete(delete_url, headers=master_headers)
 
                         if del_r.status_code != 204:
                             # something went wrong
@@ -172,7 +173,7 @@ class Onadata():
                 itemsets = {'data_file': open(file_name, 'rt')}
                 payload = {'data_type': 'media', 'data_value': resource_name, 'xform': form['formid']}
 
-                r = requests.post(url, files=itemsets, data=payload, headers=self.headers)
+                r = self.client.post(url, files=itemsets, data=payload, headers=self.headers)
                 # print("Media update response code %s " % r.status_code)
                 
                 if r.status_code != 201:
@@ -193,7 +194,7 @@ class Onadata():
             # 2. Reset the password
             url = '%s/%s' % (self.server, self.initiate_paswd_reset)
             user_details = {'email': email, 'reset_url': self.reset_url}
-            r = requests.post(url, user_details, headers=self.headers)
+            r = self.client.post(url, user_details, headers=self.headers)
             if r.status_code != 200:
                 terminal.tprint("Response %d: %s" % (r.status_code, r.text), 'fail')
                 raise Exception(r.text)
@@ -202,7 +203,7 @@ class Onadata():
             resp = r.json()
             url = '%s/%s' % (self.server, self.finalize_paswd_reset)
             user_details = {'new_password': new_password, 'uid': resp['uid'], 'token': resp['token']}
-            r = requests.post(url, user_details, headers=self.headers)
+            r = self.client.post(url, user_details, headers=self.headers)
             if r.status_code != 200:
                 terminal.tprint("Response %d: %s" % (r.status_code, r.text), 'fail')
                 raise Exception(r.text)
@@ -241,7 +242,7 @@ class Onadata():
 
                 share_url = '%s/%s' % (self.server, self.share_url % form['formid'])
                 for det in share_details:
-                    req = requests.post(share_url, data=det, headers=self.headers)
+                    req = self.client.post(share_url, data=det, headers=self.headers)
 
                     if req.status_code != 204:
                         # something went wrong
@@ -283,7 +284,7 @@ class Onadata():
     def get_form_attachment(self, form_id):
         try:
             url = '%s/%s%s' % (self.server, self.form_rep, str(form_id))
-            r = requests.get(url, headers=self.headers)
+            r = self.client.get(url, headers=self.headers)
             if r.status_code == 200:
                 return r.json()
             else:
@@ -302,7 +303,7 @@ class Onadata():
             xls_headers = {'Authorization': "Token %s" % api_token}
             print('Executing the url %s' % url)
 
-            r = requests.get(url, files=itemsets, data=payload, headers=xls_headers)
+            r = self.client.get(url, files=itemsets, data=payload, headers=xls_headers)
             print(r.status_code)
             print(r.json())
 
@@ -324,7 +325,7 @@ class Onadata():
             xls_headers = {'Authorization': "Token %s" % api_token}
             if settings.DEBUG: print('Executing the url %s' % url)
 
-            r = requests.post(url, files=itemsets, headers=xls_headers)
+            r = self.client.post(url, files=itemsets, headers=xls_headers)
             if r.status_code == 201:  # created
                 return r.json()
             else:
@@ -349,13 +350,13 @@ class Onadata():
             payload = {'current_password': user_password, 'new_password': new_password}
             print('Executing dummy password url %s' % url)
 
-            r = requests.post(url, data=payload, headers=xls_headers)
+            r = self.client.post(url, data=payload, headers=xls_headers)
             if r.status_code != 200:
                 raise Exception('There was an error while setting a new user password')
 
             payload = {'current_password': new_password, 'new_password': user_password}
             print('Reseting the real password -- %s' % url)
-            r = requests.post(url, data=payload, headers=xls_headers)
+            r = self.client.post(url, data=payload, headers=xls_headers)
             if r.status_code != 200:
                 raise Exception('There was an error while re-setting user password')
             user_details = r.json()
@@ -375,7 +376,7 @@ class Onadata():
             payload = {'username': username, 'role': role, 'remove': True}
             print("Deleting the user '%s' via '%s'" % (username, url))
 
-            r = requests.put(url, data=payload, headers=xls_headers)
+            r = self.client.put(url, data=payload, headers=xls_headers)
             if r.status_code == 204: pass
             elif r.status_code == 404:
                 if settings.DEBUG: terminal.tprint("The user '%s' was not found in the project. Perhaps the user was deleted" % username, 'info')
@@ -395,7 +396,7 @@ class Onadata():
             xls_headers = {'Authorization': "Token %s" % api_token}
             print("Deleting the project '%s'" % url)
 
-            r = requests.delete(url, headers=xls_headers)
+            r = self.client.delete(url, headers=xls_headers)
             
             if r.status_code == 204: pass
             elif r.status_code == 404:
@@ -0,0 +1,130 @@
+import json
+import threading
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import SimpleTestCase
+
+from . import caches
+from .ona_client import OnaClient, AsyncOnaClient, iter_json_array
+from .odk_forms import OdkForms
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    def test_float_split_across_chunks(self):
+        self.assertEqual(list(iter_json_array(['[3.', '5]'])), [3.5])
+        self.assertEqual(list(iter_json_array(['[1', 'e', '3, -', '2, 4.5E-', '1]'])), [1000.0, -2, 0.45])
+
+    def test_truncated_number_is_incomplete(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[3.', '5']))
+
+
+class StubCursor():
+    # a cursor over an in-memory dictionary_items table
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+        self.params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.queries.append(query)
+        self.params = params
+
+    def fetchall(self):
+        if isinstance(self.params[0], list):
+            return [(t_key, self.items[t_key]) for t_key in self.params[0] if t_key in self.items]
+        return list(self.items.items())[:self.params[0]]
+
+    def fetchone(self):
+        return (self.items[self.params[0]],) if self.params[0] in self.items else None
+
+
+class DictionaryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cursor = StubCursor({'k%d' % i: 'value %d' % i for i in range(1, 9)})
+        patcher = mock.patch.object(caches, 'connection')
+        patcher.start().cursor.return_value = self.cursor
+        self.addCleanup(patcher.stop)
+
+    def test_misses_dont_evict_the_items(self):
+        dictionary_cache = caches.DictionaryCache(max_size=10, ttl=300)
+        for i in range(5):
+            self.assertIsNone(dictionary_cache.get('missing%d' % i))
+        self.assertEqual(dictionary_cache.get_many(['missing5', 'k2']), {'missing5': None, 'k2': 'value 2'})
+
+        self.assertEqual(dictionary_cache.get('k1'), 'value 1')
+        # the whole table is cached, so only the initial load hits the database
+        self.assertEqual(len(self.cursor.queries), 1)
+
+    def test_evicted_items_are_looked_up_again(self):
+        # the table doesn't fit in the cache, so the misses are cached and evict the items
+        dictionary_cache = caches.DictionaryCache(max_size=8, ttl=300)
+        self.assertEqual(dictionary_cache.get('k1'), 'value 1')
+        self.assertFalse(dictionary_cache.is_complete)
+        for i in range(5):
+            self.assertIsNone(dictionary_cache.get('missing%d' % i))
+        self.assertEqual(dictionary_cache.get('k2'), 'value 2')
+        self.assertEqual(dictionary_cache.get('k3'), 'value 3')
+
+
+class StubOnadataHandler(BaseHTTPRequestHandler):
+    # responds with the JSON saved for the requested path, or a 404
+    responses = {
+        '/api/v1/forms/1/form.json': {'name': 'form_1', 'children': []},
+        '/api/v1/forms/2/form.json': {'name': 'form_2', 'children': []},
+        '/api/v1/metadata?xform=1': [],
+        '/api/v1/metadata?xform=2': [{'id': 5, 'data_file_type': 'text/csv'}],
+    }
+
+    def do_GET(self):
+        if self.path not in self.responses:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = json.dumps(self.responses[self.path]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FanOutTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubOnadataHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.server_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_fetch_many_keeps_the_order_of_the_urls(self):
+        client = AsyncOnaClient(OnaClient(max_retries=0), concurrency=2)
+        urls = ['%s%s' % (self.server_url, path) for path in ['/api/v1/forms/2/form.json', '/missing', '/api/v1/forms/1/form.json']]
+        responses = client.fetch_many(urls)
+        self.assertEqual(responses, [{'name': 'form_2', 'children': []}, None, {'name': 'form_1', 'children': []}])
+
+    def test_fetch_forms_resources(self):
+        with self.settings(ONADATA_URL=self.server_url):
+            odk_forms = OdkForms()
+        odk_forms.client = OnaClient(max_retries=0)
+        all_resources = odk_forms.fetch_forms_resources([1, 2, 3], concurrency=3)
+        self.assertEqual(all_resources[1], {'structure': {'name': 'form_1', 'children': []}, 'metadata': []})
+        self.assertEqual(all_resources[2]['metadata'], [{'id': 5, 'data_file_type': 'text/csv'}])
+        self.assertEqual(all_resources[3], {'structure': None, 'metadata': None})
@@ -15,7 +15,7 @@ from django.contrib.staticfiles import finders
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.views import static
-from django.http import HttpResponse, Http404, JsonResponse
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.middleware import csrf
 from django.forms.models import model_to_dict
@@ -228,14 +228,12 @@ def download_data(request):
         return response
 
     if res['is_downloadable'] is True:
-        filename = res['filename']
-        wrapper = FileWrapper(open(filename, 'rb'))
-        response = HttpResponse(wrapper, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(filename)
-        response['Content-Length'] = os.path.getsize(filename)
+        # the file is streamed to the client as it is written, so its length is not known
+        response = StreamingHttpResponse(res['content'], content_type=res['content_type'])
+        response['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(res['filename'])
     else:
-        response = HttpResponse(json.dumps({'error': False, 'message': res['message']}), content_type='text/json')
-        response['Content-Message'] = json.dumps({'error': False, 'message': res['message']})
+        response = HttpResponse(json.dumps({'error': res['error'], 'message': res['message']}), content_type='text/json')
+        response['Content-Message'] = json.dumps({'error': res['error'], 'message': res['message']})
 
     return response
 